@@ -0,0 +1,250 @@
+import argparse
+import json
+import math
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+
+from termcolor import colored, cprint
+
+from simulator import check_recombineItems, getBaFreq, getCorpus, getLevel3Outcomes, getOutcomeGoodness, recombineItems
+from valuable import ValuablePattern, compileValuableMods
+
+
+# Leave-one-out backtest of recombineItems against the recorded corpus
+# For every record, the record is taken out of the frequency table (so bafreq no longer includes it), its inputs are
+#   simulated and the observed output is scored under the predicted distribution, then the record is added back
+# By default every mod counts as valuable, so states name exactly which mods survived and the log-likelihood scores
+#   the whole prediction, pass other valuable mods to score at a coarser level
+# The base is left out of the scored state, the model always gives each base 1/2
+#
+# python backtest.py                         backtest the corpus in data/ across every core
+# python backtest.py --output results.json   also save the per-record results, eg to compare model changes
+
+# Probability used for outcomes the model gives no chance at all, so one impossible record doesn't make the total -inf
+IMPOSSIBLE_FLOOR = 1e-6
+
+LEVEL3_CATEGORIES = ['green', 'yellow', 'red', 'BRICK']
+
+# Upper edges of the predicted probability bins in the calibration table
+CALIBRATION_BINS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+default_valuable_mods = [ValuablePattern('', 99)]
+
+
+@dataclass
+class BacktestResult:
+    name: str
+    log_likelihood: float # Natural log, floored at IMPOSSIBLE_FLOOR
+    impossible: bool # Observed output had no predicted chance at all
+    observed_category: str
+    level3: dict # Predicted chance per level 3 category
+    seconds: float
+
+
+@dataclass
+class BacktestReport:
+    results: list[BacktestResult] = field(default_factory=list)
+    skipped: list = field(default_factory=list) # (name, reason)
+    wall_seconds: float = 0
+
+
+def getScoredState(pools, valuable_mods):
+    # (sorted prefix descriptions, sorted suffix descriptions) with non valuable mods as junk, for both the
+    #   predicted states and the observed output
+    scored = []
+    for slot, mod_pool in zip(['Prefix', 'Suffix'], pools):
+        scored.append(tuple(sorted(
+            m.stringDescription() if not m.stringDescription().startswith('Junk') and valuable_mods.isValuable(m) else f'Junk {slot}'
+            for m in mod_pool
+        )))
+    return tuple(scored)
+
+
+def getValuableAffixCount(item, valuable_mods):
+    # Only prefixes and suffixes go through the recomb, so implicits never count (the default rule matches them too)
+    return valuable_mods.getValuableCount(item.getAffixes())
+
+
+def getObservedCategory(output, valuable_inputs, valuable_mods):
+    valuables = getValuableAffixCount(output, valuable_mods)
+    if valuables == 0:
+        return 'BRICK'
+    return getOutcomeGoodness(valuables, max(valuable_inputs))
+
+
+def backtestRecord(name, record, valuable_mods, engine='cached'):
+    # Score one record with it removed from bafreq, the caller must add it back (see leaveOneOut)
+    start = time.perf_counter()
+    item1, item2, output = record['input1'], record['input2'], record['output']
+    output_to_percent = recombineItems(item1, item2, valuable_mods, engine=engine)
+
+    predicted = Counter()
+    for state, percent in output_to_percent.items():
+        predicted[getScoredState(state[1:], valuable_mods)] += percent
+    observed = getScoredState([output.getPrefixes(), output.getSuffixes()], valuable_mods)
+    p_observed = predicted[observed]
+
+    valuable_inputs = (getValuableAffixCount(item1, valuable_mods), getValuableAffixCount(item2, valuable_mods))
+    level3_outcomes = getLevel3Outcomes(output_to_percent, valuable_inputs)
+    return BacktestResult(
+        name = name,
+        log_likelihood = math.log(max(p_observed, IMPOSSIBLE_FLOOR)),
+        impossible = p_observed <= 0,
+        observed_category = getObservedCategory(output, valuable_inputs, valuable_mods),
+        level3 = {category: level3_outcomes[category] for category in LEVEL3_CATEGORIES},
+        seconds = time.perf_counter() - start,
+    )
+
+
+def leaveOneOut(name, valuable_mods, engine):
+    # Takes the record out of the frequency table, which updates bafreq rows in place, and always puts it back
+    corpus = getCorpus()
+    record = corpus.recombs[name]
+    corpus.frequency_table.removeRecord(name, record)
+    try:
+        ok, reason = check_recombineItems(record['input1'], record['input2'], valuable_mods)
+        if not ok:
+            return (name, reason)
+        bafreq = getBaFreq()
+        item1, item2 = record['input1'], record['input2']
+        for in_pool in [len(item1.getPrefixes() + item2.getPrefixes()), len(item1.getSuffixes() + item2.getSuffixes())]:
+            if in_pool not in bafreq:
+                return (name, f'No other recombs with pool size {in_pool}')
+        return backtestRecord(name, record, valuable_mods, engine)
+    finally:
+        corpus.frequency_table.addRecord(name, record)
+
+
+# Set per worker by initBacktestWorker, every worker loads its own corpus and frequency table
+worker_valuable_mods = None
+worker_engine = None
+
+
+def initBacktestWorker(valuable_mods, engine):
+    global worker_valuable_mods, worker_engine
+    worker_valuable_mods = valuable_mods
+    worker_engine = engine
+    getCorpus()
+
+
+def backtestWorker(name):
+    return leaveOneOut(name, worker_valuable_mods, worker_engine)
+
+
+def runBacktest(valuable_mods=default_valuable_mods, engine='cached', max_workers=None, limit=None, chunksize=8):
+    # Leave-one-out over every complete record in the corpus, spread across processes (max_workers=1 runs inline)
+    valuable_mods = compileValuableMods(valuable_mods)
+    corpus = getCorpus()
+    names = []
+    report = BacktestReport()
+    for name, record in sorted(corpus.recombs.items()):
+        if any(item_type not in record or record[item_type] is None for item_type in ['input1', 'input2', 'output']):
+            report.skipped.append((name, 'Incomplete record'))
+        elif name not in corpus.frequency_table.records:
+            report.skipped.append((name, 'Not in the frequency table'))
+        else:
+            names.append(name)
+    names = names[:limit]
+
+    start = time.perf_counter()
+    if max_workers == 1:
+        initBacktestWorker(valuable_mods, engine)
+        outcomes = [backtestWorker(name) for name in names]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=initBacktestWorker,
+            initargs=(valuable_mods, engine),
+        ) as executor:
+            outcomes = list(executor.map(backtestWorker, names, chunksize=chunksize))
+    report.wall_seconds = time.perf_counter() - start
+
+    for outcome in outcomes:
+        if isinstance(outcome, BacktestResult):
+            report.results.append(outcome)
+        else:
+            report.skipped.append(outcome)
+    return report
+
+
+def getCalibrationTable(results):
+    # category -> [(bin upper edge, records, mean predicted chance, observed frequency)] over non empty bins
+    table = {}
+    for category in LEVEL3_CATEGORIES:
+        bins = defaultdict(list)
+        for result in results:
+            p = result.level3[category]
+            bin_index = next(i for i, edge in enumerate(CALIBRATION_BINS) if p <= edge or i == len(CALIBRATION_BINS) - 1)
+            bins[bin_index].append((p, result.observed_category == category))
+        table[category] = [
+            (CALIBRATION_BINS[i], len(entries), sum(p for p, _ in entries) / len(entries), sum(hit for _, hit in entries) / len(entries))
+            for i, entries in sorted(bins.items())
+        ]
+    return table
+
+
+def getBrierScore(results):
+    # Mean squared error of the level 3 category chances against the observed category (0 is perfect, 2 is worst)
+    if not results:
+        return None
+    return sum(
+        sum((result.level3[category] - (result.observed_category == category))**2 for category in LEVEL3_CATEGORIES)
+        for result in results
+    ) / len(results)
+
+
+def getReportSummary(report):
+    results = report.results
+    scored = len(results)
+    return {
+        'records': scored,
+        'skipped': len(report.skipped),
+        'mean_log_likelihood': sum(r.log_likelihood for r in results) / scored if scored else None,
+        'impossible': sum(r.impossible for r in results),
+        'level3_accuracy': sum(max(r.level3, key=r.level3.get) == r.observed_category for r in results) / scored if scored else None,
+        'level3_brier': getBrierScore(results),
+        'records_per_second': scored / report.wall_seconds if report.wall_seconds else None,
+        'simulate_seconds': sum(r.seconds for r in results),
+    }
+
+
+def pprintBacktestReport(report):
+    summary = getReportSummary(report)
+    if not summary['records']:
+        cprint(f'Nothing to backtest, {summary["skipped"]} records skipped', 'red')
+        return summary
+
+    cprint(f'Backtested {summary["records"]} records ({summary["skipped"]} skipped) in {report.wall_seconds:.2f}s, {summary["records_per_second"]:.1f} records/s', 'green')
+    print(f'Mean log-likelihood: {summary["mean_log_likelihood"]:.4f}')
+    impossible_color = 'red' if summary['impossible'] else None
+    print(colored(f'Impossible outcomes: {summary["impossible"]} (scored as {IMPOSSIBLE_FLOOR:g})', impossible_color))
+    print(f'Level 3 accuracy: {summary["level3_accuracy"]*100:.1f}%, Brier score: {summary["level3_brier"]:.4f}')
+
+    observed = Counter(r.observed_category for r in report.results)
+    print('Calibration (predicted bin, records, mean predicted, observed):')
+    for category, rows in getCalibrationTable(report.results).items():
+        cprint(f'    {category}: observed {observed[category] / summary["records"]*100:.1f}%', 'white')
+        for edge, count, mean_predicted, observed_frequency in rows:
+            print(f'        <= {edge:.1f} {count:6d} {mean_predicted*100:6.1f}% {observed_frequency*100:6.1f}%')
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Leave-one-out backtest of the simulator against the recorded corpus')
+    parser.add_argument('--engine', default='cached', choices=['python', 'numpy', 'cached'])
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, 1 runs inline (default: every core)')
+    parser.add_argument('--limit', type=int, default=None, help='Only backtest the first N records')
+    parser.add_argument('--output', default=None, help='Write the summary and per-record results as JSON')
+    args = parser.parse_args()
+
+    report = runBacktest(engine=args.engine, max_workers=args.workers, limit=args.limit)
+    summary = pprintBacktestReport(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'summary': summary,
+                'results': [asdict(result) for result in report.results],
+                'skipped': report.skipped,
+            }, f, indent=2)
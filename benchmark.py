@@ -0,0 +1,278 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from termcolor import colored, cprint
+
+
+# Benchmarks for the parser, loader, simulator and reporting hot paths
+# Everything runs on a synthetic corpus generated from proto/ctrlaltc.txt and a fixed pool size table,
+#   so results only depend on the code and the machine, not on what is in data/json
+#
+# python benchmark.py                      run everything, write benchmark_results.json and compare to the baseline
+# python benchmark.py --save-baseline      run everything and store the results as the new baseline
+# python benchmark.py --require-baseline   same as the first, but a missing baseline fails instead of passing, to gate a change
+# python benchmark.py --filter recombine   only run benchmarks whose name contains "recombine"
+
+repo_dir = Path(__file__).resolve().parent
+proto_path = repo_dir / 'proto/ctrlaltc.txt'
+default_output_path = repo_dir / 'benchmark_results.json'
+default_baseline_path = repo_dir / 'benchmark_baseline.json'
+
+SEPARATOR = '--------'
+
+# Fixed input pool size -> output pool size frequencies, used instead of the corpus derived bafreq
+SYNTHETIC_BAFREQ = {
+    0: {0: 1.0},
+    1: {1: 1.0},
+    2: {1: 0.5, 2: 0.5},
+    3: {1: 0.3, 2: 0.35, 3: 0.35},
+    4: {1: 0.25, 2: 0.25, 3: 0.5},
+    5: {1: 0.15, 2: 0.2, 3: 0.65},
+    6: {1: 0.05, 2: 0.1, 3: 0.85},
+}
+
+
+def splitProtoItem(lines):
+    # Split a Ctrl+Alt+C copy into (lines before the first modifier group, modifier blocks, lines after the modifiers)
+    first_mod = next(i for i, line in enumerate(lines) if line.startswith('{'))
+    end = next((i for i in range(first_mod, len(lines)) if lines[i] == SEPARATOR), len(lines))
+
+    blocks = []
+    for line in lines[first_mod:end]:
+        if line.startswith('{'):
+            blocks.append([])
+        blocks[-1].append(line)
+    return lines[:first_mod], blocks, lines[end:]
+
+
+def varyModBlock(rng, block):
+    # Re-roll the tier and the first rolled value so generated mods don't all share identical stats
+    header = re.sub(r'\(Tier: \d+\)', f'(Tier: {rng.randint(1, 7)})', block[0])
+    effects = [re.sub(r'^(\D*)\d+\(', lambda m: f'{m.group(1)}{rng.randint(10, 99)}(', line, count=1) for line in block[1:]]
+    return [header] + effects
+
+
+def makeSyntheticCorpus(json_dir, record_count, seed=0):
+    rng = random.Random(seed)
+    with open(proto_path, 'r') as f:
+        proto_lines = f.read().splitlines()
+    head, blocks, tail = splitProtoItem(proto_lines)
+    prefix_blocks = [b for b in blocks if 'Prefix' in b[0]]
+    suffix_blocks = [b for b in blocks if 'Suffix' in b[0]]
+
+    def makeItem(prefixes, suffixes):
+        mods = [varyModBlock(rng, b) for b in prefixes + suffixes]
+        return head + [line for block in mods for line in block] + tail
+
+    def pickMods():
+        prefixes = rng.sample(prefix_blocks, rng.randint(0, len(prefix_blocks)))
+        suffixes = rng.sample(suffix_blocks, rng.randint(1, len(suffix_blocks)))
+        return prefixes, suffixes
+
+    os.makedirs(json_dir, exist_ok=True)
+    for i in range(1, record_count + 1):
+        p1, s1 = pickMods()
+        p2, s2 = pickMods()
+        prefix_pool = p1 + p2
+        suffix_pool = s1 + s2
+        po = rng.sample(prefix_pool, min(3, rng.randint(0, len(prefix_pool))))
+        so = rng.sample(suffix_pool, min(3, rng.randint(1, len(suffix_pool))))
+        record = {'input1': makeItem(p1, s1), 'input2': makeItem(p2, s2), 'output': makeItem(po, so)}
+        with open(Path(json_dir) / f'{str(i).zfill(5)}.json', 'w') as f:
+            json.dump(record, f, indent=2)
+
+
+def makeGridItems(prefix_count, suffix_count, valuable_count):
+    # Two items splitting prefix_count/suffix_count synthetic mods, the first valuable_count mods of each pool valuable
+    from poe_types import PoEEffect, PoEItem, PoEMod, PoEReq, PoESocket
+    from valuable import ValuableMod
+
+    def makeMods(slot, count):
+        return [
+            PoEMod(f'{slot} Modifier', '', 1, [], [PoEEffect([1.0], [[1.0, 1.0]], f'X to Synthetic {slot} {i}', [])])
+            for i in range(count)
+        ]
+
+    prefixes = makeMods('Prefix', prefix_count)
+    suffixes = makeMods('Suffix', suffix_count)
+    items = []
+    for half in [0, 1]:
+        mods = prefixes[half::2] + suffixes[half::2]
+        items.append(PoEItem('One Hand Axes', 'Rare', '', 'Reaver Axe', {}, PoEReq(), PoESocket(''), 85, mods, []))
+
+    valuable_mods = [
+        ValuableMod(m.stringDescription(), 1)
+        for pool in [prefixes, suffixes] for m in pool[:valuable_count]
+    ]
+    return items[0], items[1], valuable_mods
+
+
+def timeIt(fxn, repeat, number=1):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fxn()
+        times.append((time.perf_counter() - start) / number)
+    return {'best_s': min(times), 'mean_s': sum(times) / len(times), 'repeat': repeat, 'number': number}
+
+
+def getBenchmarks(json_dir, quick):
+    # Returns [(name, fxn, number)], imports happen here once the synthetic corpus is the current directory
+    import simulator
+    import utils
+    from recomb_queries import getAtLeastChance, getLevel3Chances
+    from simulator import pprintRecombinatorOutcomes, recombineItems, recombineItemsCompact, summarizeRecombOutcomes
+
+    files = [Path(json_dir) / name for name in sorted(os.listdir(json_dir))]
+    raw_items = []
+    for full_fpath in files:
+        with open(full_fpath, 'r') as f:
+            raw_json = json.load(f)
+        raw_items.extend(raw_json[item_type] for item_type in ['input1', 'input2', 'output'])
+    recombs = utils.loadRecombsFromFileList(files)
+
+    benchmarks = [
+        ('parse_item', lambda: [utils.parseItem(lines, 'benchmark') for lines in raw_items], 1),
+        ('parse_item_legacy', lambda: [utils.parseItemLegacy(lines, 'benchmark') for lines in raw_items], 1),
+        ('load_recombs', lambda: utils.loadRecombsFromFileList(files), 1),
+    ]
+    for fxn in [utils.getMatchingModIndices, utils.getMatchingModIndicesLegacy]:
+        benchmarks.append((
+            f'matching_mod_indices.{fxn.__name__}',
+            lambda fxn=fxn: [
+                fxn(data[left].mods, data[right].mods)
+                for data in recombs.values()
+                for left, right in [('input1', 'input2'), ('input1', 'output'), ('input2', 'output')]
+            ],
+            1,
+        ))
+
+    pool_sizes = [2, 4, 6] if quick else [1, 2, 3, 4, 5, 6]
+    for prefix_count in pool_sizes:
+        for suffix_count in pool_sizes:
+            for valuable_count in sorted({0, 1, min(prefix_count, suffix_count)}):
+                item1, item2, valuable_mods = makeGridItems(prefix_count, suffix_count, valuable_count)
+                grid_name = f'p{prefix_count}_s{suffix_count}_v{valuable_count}'
+                for engine in ['python', 'numpy', 'cached']:
+                    benchmarks.append((
+                        f'recombine.{engine}.{grid_name}',
+                        lambda item1=item1, item2=item2, valuable_mods=valuable_mods, engine=engine: recombineItems(item1, item2, valuable_mods, engine=engine),
+                        5,
+                    ))
+                benchmarks.append((
+                    f'recombine.compact.{grid_name}',
+                    lambda item1=item1, item2=item2, valuable_mods=valuable_mods: recombineItemsCompact(item1, item2, valuable_mods),
+                    5,
+                ))
+
+    item1, item2, valuable_mods = makeGridItems(6, 6, 3)
+    output_to_percent = recombineItems(item1, item2, valuable_mods)
+    valuable_inputs = (item1.getValuableCount(valuable_mods), item2.getValuableCount(valuable_mods))
+    benchmarks.append(('summarize_outcomes', lambda: summarizeRecombOutcomes(output_to_percent, valuable_inputs), 5))
+    benchmarks.append(('queries.level3', lambda: getLevel3Chances(item1, item2, valuable_mods), 100))
+    benchmarks.append(('queries.at_least', lambda: getAtLeastChance(item1, item2, valuable_mods, 2), 100))
+    for compression_level in range(0, 4):
+        def printOutcomes(compression_level=compression_level):
+            with contextlib.redirect_stdout(io.StringIO()):
+                pprintRecombinatorOutcomes(output_to_percent, valuable_inputs, compression_level=compression_level)
+        benchmarks.append((f'pprint.level{compression_level}', printOutcomes, 5))
+
+    return benchmarks
+
+
+def compareResults(results, baseline, threshold):
+    # Print a current vs baseline table, returns names that got slower than threshold x baseline
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            print(f'{name.ljust(60)} {result["best_s"]*1000:10.3f}ms   (new)')
+            continue
+        ratio = result['best_s'] / baseline['results'][name]['best_s']
+        color = 'red' if ratio > threshold else 'green' if ratio < 1 / threshold else None
+        if ratio > threshold:
+            regressions.append(name)
+        print(f'{name.ljust(60)} {result["best_s"]*1000:10.3f}ms ', colored(f'{ratio:6.2f}x', color))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parser, loader, simulator and reporting hot paths')
+    parser.add_argument('--output', type=Path, default=default_output_path)
+    parser.add_argument('--baseline', type=Path, default=default_baseline_path)
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--require-baseline', action='store_true', help='Exit with 1 if there is no baseline to compare to')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--records', type=int, default=300, help='Synthetic corpus size')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio reported as a regression')
+    parser.add_argument('--quick', action='store_true', help='Smaller pool size grid')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_dir = Path(tmp_dir) / 'data/json'
+        makeSyntheticCorpus(json_dir, args.records)
+
+        # simulator loads data/json relative to the working directory
+        os.chdir(tmp_dir)
+        sys.path.insert(0, str(repo_dir))
+        import simulator
+        with contextlib.redirect_stdout(io.StringIO()):
+            bafreq = simulator.getBaFreq()
+        bafreq.clear()
+        bafreq.update(SYNTHETIC_BAFREQ)
+
+        results = {
+            'meta': {
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'records': args.records,
+            },
+            'results': {},
+        }
+        for name, fxn, number in getBenchmarks(json_dir, args.quick):
+            if args.filter not in name:
+                continue
+            results['results'][name] = timeIt(fxn, args.repeat, number)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    cprint(f'Wrote {len(results["results"])} results to {args.output}', 'blue')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        cprint(f'Saved baseline to {args.baseline}', 'blue')
+        return 0
+
+    if not args.baseline.exists():
+        # Baselines are per machine, so none is committed, without one nothing was compared
+        if args.require_baseline:
+            cprint(f'No baseline at {args.baseline}, nothing was compared, run with --save-baseline to create one', 'red')
+            return 1
+        cprint(f'Warning: no baseline at {args.baseline}, nothing was compared, run with --save-baseline to create one', 'yellow')
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compareResults(results, baseline, args.threshold)
+    if regressions:
+        cprint(f'{len(regressions)} regression(s) over {args.threshold}x baseline', 'red')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import argparse
+import contextlib
+import io
+import sys
+from pathlib import Path
+
+from termcolor import cprint
+
+
+# Consistency checks between the fast paths and the reference implementations they replaced
+# Each check prints what disagrees and the script exits with 1 if any check fails, so it can gate a change
+#
+# python checks.py                 run every check
+# python checks.py parse           only check parseItem against parseItemLegacy
+# python checks.py engines         only check the recombine engines against each other
+# python checks.py queries         only check the closed-form recomb queries against the python engine
+# python checks.py monte_carlo     only check the Monte Carlo sampler against the python engine
+
+repo_dir = Path(__file__).resolve().parent
+proto_dir = repo_dir / 'proto'
+json_dir = Path().parent / 'data/json'
+
+# Pool sizes and valuable counts per pool covered by the engine checks, run on benchmark's fixed bafreq
+GRID_POOL_SIZES = range(0, 7)
+GRID_VALUABLE_COUNTS = range(0, 4)
+
+# The Monte Carlo check samples a smaller grid, with bafreq rows that allow output sizes bigger than the pool so the
+#   mass the engines drop is covered too
+MONTE_CARLO_POOL_SIZES = range(0, 5)
+MONTE_CARLO_VALUABLE_COUNTS = range(0, 3)
+MONTE_CARLO_BAFREQ_ROWS = {
+    1: {1: 0.6, 2: 0.4},
+    2: {1: 0.3, 2: 0.3, 3: 0.4},
+}
+# Allowed difference per state, in standard errors of the sampled chance
+MONTE_CARLO_Z = 5
+
+
+def useSyntheticBaFreq(rows=None):
+    # Swap in an empty corpus with benchmark.SYNTHETIC_BAFREQ, so the grid checks don't depend on (or load) data/
+    # rows replaces some of its rows
+    import simulator
+    from benchmark import SYNTHETIC_BAFREQ
+    from frequency_table import FrequencyTable
+
+    bafreq = {in_pool: dict(row) for in_pool, row in {**SYNTHETIC_BAFREQ, **(rows or {})}.items()}
+    simulator.corpus = simulator.Corpus({}, FrequencyTable(bafreq))
+
+
+def iterGrid(pool_sizes=GRID_POOL_SIZES, valuable_counts=GRID_VALUABLE_COUNTS):
+    # (grid label, item1, item2, valuable mods) for every prefix/suffix pool size and valuable count combination
+    from benchmark import makeGridItems
+
+    for prefix_count in pool_sizes:
+        for suffix_count in pool_sizes:
+            for valuable_count in valuable_counts:
+                if valuable_count > max(prefix_count, suffix_count):
+                    continue
+                item1, item2, valuable_mods = makeGridItems(prefix_count, suffix_count, valuable_count)
+                yield f'P{prefix_count} S{suffix_count} V{valuable_count}', item1, item2, valuable_mods
+
+
+def iterSharedTextCases():
+    # Grid items plus a copy of item1's first prefix on item2, with the same text but other rolls, which either shares
+    #   its mod group (a doubled mod, its states merge) or has another group (distinct mods that happen to share text)
+    # Yields (label, item1, item2, valuable mods, distinct valuable prefixes every engine must keep apart)
+    from copy import deepcopy
+
+    from benchmark import makeGridItems
+    from mod_identity import mod_identity_table
+
+    for prefix_count in range(1, 5):
+        for suffix_count in range(0, 3):
+            for same_group in [True, False]:
+                item1, item2, valuable_mods = makeGridItems(prefix_count, suffix_count, prefix_count)
+                original = item1.getPrefixes()[0]
+                shared = deepcopy(original)
+                shared.effects[0].actual_stats = [2.0]
+                original.identity = mod_identity_table.intern(('group', 'SyntheticShared'))
+                if same_group:
+                    shared.identity = original.identity
+                else:
+                    shared.title = 'Synthetic'
+                    shared.identity = mod_identity_table.intern(('group', 'SyntheticSharedOther'))
+                item2.mods.append(shared)
+                group_label = 'same group' if same_group else 'other group'
+                yield (
+                    f'P{prefix_count} S{suffix_count} shared text, {group_label}',
+                    item1, item2, valuable_mods,
+                    prefix_count if same_group else prefix_count + 1,
+                )
+
+
+def checkParse():
+    # parseItem against parseItemLegacy over every record in data/json and every item in the proto/ dumps
+    from item_stream import iterItemBlocks
+    from utils import checkParseItemEquivalence, parseItem, parseItemLegacy
+
+    mismatched = []
+    recombination_files_full = sorted(json_dir.glob('*.json')) if json_dir.exists() else []
+    mismatched += [f'{fpath} {item_type}' for fpath, item_type in checkParseItemEquivalence(recombination_files_full)]
+
+    proto_paths = sorted(proto_dir.glob('*.txt'))
+    item_count = 0
+    for proto_path in proto_paths:
+        with open(proto_path, 'r', encoding='utf-8') as f:
+            for line_number, block in iterItemBlocks(f):
+                item_count += 1
+                with contextlib.redirect_stdout(io.StringIO()):
+                    expected = parseItemLegacy(block, proto_path.name)
+                    actual = parseItem(block, proto_path.name)
+                if expected != actual:
+                    mismatched.append(f'{proto_path.name} line {line_number}')
+
+    checked = f'{len(recombination_files_full)} records and {item_count} proto items'
+    return checked, mismatched
+
+
+def describeEngineMismatches(label, states):
+    engines = sorted({engine for engine, _, _, _ in states})
+    return f'{label}: {len(states)} states differ ({", ".join(engines)})'
+
+
+def checkEngines():
+    # checkRecombineEngines over the pool size grid, and over prefixes sharing their text with another mod
+    from mod_identity import getModIdentity
+    from simulator import checkRecombineEngines, isJunkMod, recombineItems
+
+    useSyntheticBaFreq()
+    mismatched = []
+    grid_count = 0
+    for label, item1, item2, valuable_mods in iterGrid():
+        grid_count += 1
+        ok, states = checkRecombineEngines(item1, item2, valuable_mods)
+        if not ok:
+            mismatched.append(describeEngineMismatches(label, states))
+
+    case_count = 0
+    for label, item1, item2, valuable_mods, distinct_count in iterSharedTextCases():
+        case_count += 1
+        ok, states = checkRecombineEngines(item1, item2, valuable_mods)
+        if not ok:
+            mismatched.append(describeEngineMismatches(label, states))
+        output_to_percent = recombineItems(item1, item2, valuable_mods, engine='python')
+        identities = {getModIdentity(m) for state in output_to_percent for m in state[1] if not isJunkMod(m)}
+        if len(identities) != distinct_count:
+            mismatched.append(f'{label}: {len(identities)} distinct valuable prefixes, expected {distinct_count}')
+    return f'{grid_count} grid points and {case_count} shared text cases', mismatched
+
+
+def checkQueries():
+    # checkRecombQueries over the pool size grid and the shared text cases
+    from recomb_queries import checkRecombQueries
+
+    useSyntheticBaFreq()
+    mismatched = []
+    cases = list(iterGrid()) + [case[:4] for case in iterSharedTextCases()]
+    for label, item1, item2, valuable_mods in cases:
+        ok, queries = checkRecombQueries(item1, item2, valuable_mods)
+        mismatched += [f'{label}: {query} expected {expected:.6g}, got {actual:.6g}' for query, expected, actual in queries]
+    return f'{len(cases)} grid points and shared text cases', mismatched
+
+
+def checkMonteCarlo():
+    # recombineItemsMonteCarlo (default weights, no doubled mods) against the python engine, per state
+    import math
+
+    from monte_carlo import recombineItemsMonteCarlo
+    from simulator import recombineItems
+
+    useSyntheticBaFreq(MONTE_CARLO_BAFREQ_ROWS)
+    mismatched = []
+    grid_count = 0
+    for label, item1, item2, valuable_mods in iterGrid(MONTE_CARLO_POOL_SIZES, MONTE_CARLO_VALUABLE_COUNTS):
+        grid_count += 1
+        expected = recombineItems(item1, item2, valuable_mods, engine='python')
+        result = recombineItemsMonteCarlo(item1, item2, valuable_mods, seed=0)
+        for state in set(expected) | set(result.output_to_percent):
+            p = expected.get(state, 0)
+            sampled = result.output_to_percent.get(state, 0)
+            if abs(sampled - p) > MONTE_CARLO_Z * math.sqrt(p * (1 - p) / result.samples) + 1e-9:
+                mismatched.append(f'{label}: state expected {p:.4f}, sampled {sampled:.4f} over {result.samples} samples')
+    return f'{grid_count} grid points', mismatched
+
+
+CHECKS = {
+    'parse': checkParse,
+    'engines': checkEngines,
+    'queries': checkQueries,
+    'monte_carlo': checkMonteCarlo,
+}
+
+
+def runChecks(names):
+    failed = []
+    for name in names:
+        checked, mismatched = CHECKS[name]()
+        if mismatched:
+            failed.append(name)
+            cprint(f'{name}: {len(mismatched)} mismatches over {checked}', 'red')
+            for mismatch in mismatched:
+                print(f'    {mismatch}')
+        else:
+            cprint(f'{name}: ok over {checked}', 'green')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fast paths against their reference implementations')
+    parser.add_argument('checks', nargs='*', help=f'Checks to run, any of {", ".join(CHECKS)} (default: all)')
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f'unknown checks: {", ".join(unknown)}')
+
+    failed = runChecks(args.checks or list(CHECKS))
+    sys.exit(1 if failed else 0)
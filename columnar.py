@@ -0,0 +1,293 @@
+import argparse
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from termcolor import cprint
+
+from corpus_cache import getParseVersion
+
+
+# Columnar export of the parsed corpus, for analysis without parseItem
+# recombs are flattened into three tables, one row per record, per item and per mod, written as uncompressed Arrow IPC
+#   files (memory-mapped on load, so opening them is near instant) or Parquet
+#
+# python columnar.py                     export the corpus in data/ to data/columnar/*.arrow
+# python columnar.py --format parquet    same as Parquet, smaller but read into memory on load
+#
+# In a notebook:
+#   columnar = loadColumnar()
+#   records = columnar.filterRecords(iclass='One Hand Axes', prefix_pool=4)
+#   mods = columnar.getMods(records).to_pandas()
+
+default_columnar_path = Path().parent / 'data/columnar'
+
+# Bump whenever a table's columns change
+COLUMNAR_VERSION = 1
+
+TABLE_NAMES = ['records', 'items', 'mods']
+ITEM_TYPES = ['input1', 'input2', 'output']
+
+RECORD_SCHEMA = pa.schema([
+    ('record_id', pa.int32()),
+    ('name', pa.string()),
+    ('iclass', pa.string()), # Of input1, inputs always share the class
+    ('prefix_pool', pa.int8()), # Input pool sizes, same as utils.getRecordPoolSizes
+    ('suffix_pool', pa.int8()),
+    ('output_prefixes', pa.int8()),
+    ('output_suffixes', pa.int8()),
+    ('base_side', pa.int8()), # 0 if the output has input1's base, 1 for input2's, None if both or neither
+])
+
+ITEM_SCHEMA = pa.schema([
+    ('item_id', pa.int32()),
+    ('record_id', pa.int32()),
+    ('item_type', pa.string()),
+    ('iclass', pa.string()),
+    ('rarity', pa.string()),
+    ('name', pa.string()),
+    ('base', pa.string()),
+    ('ilvl', pa.int16()),
+    ('req_level', pa.int16()),
+    ('req_str', pa.int16()),
+    ('req_dex', pa.int16()),
+    ('req_int', pa.int16()),
+    ('sockets', pa.string()),
+    ('special_types', pa.list_(pa.string())),
+    ('implicit_count', pa.int8()),
+    ('prefix_count', pa.int8()),
+    ('suffix_count', pa.int8()),
+])
+
+MOD_SCHEMA = pa.schema([
+    ('record_id', pa.int32()),
+    ('item_id', pa.int32()),
+    ('item_type', pa.string()),
+    ('mod_index', pa.int8()), # Index in item.mods
+    ('slot', pa.string()),
+    ('category', pa.string()),
+    ('title', pa.string()),
+    ('tier', pa.int16()),
+    ('description', pa.string()),
+    ('tags', pa.list_(pa.string())),
+    ('doubled', pa.bool_()),
+    ('doubled_index', pa.int8()), # Index of the matching mod in the other input, None if not doubled
+    ('kept', pa.bool_()), # For outputs, whether any input mod was kept as this one
+    ('kept_index', pa.int8()), # Index of the output mod this input mod was kept as, None if not kept
+    ('repoe_mod_id', pa.string()),
+    ('mod_group', pa.string()),
+])
+
+# Low cardinality string columns, stored dictionary encoded
+DICTIONARY_COLUMNS = {'iclass', 'item_type', 'rarity', 'slot', 'category', 'description'}
+
+
+def flattenRecombs(recombs):
+    # Column lists for every table, records with an item that failed to parse are left out
+    records = {name: [] for name in RECORD_SCHEMA.names}
+    items = {name: [] for name in ITEM_SCHEMA.names}
+    mods = {name: [] for name in MOD_SCHEMA.names}
+
+    record_id = 0
+    item_id = 0
+    for name, data in recombs.items():
+        if any(data.get(item_type) is None for item_type in ITEM_TYPES):
+            continue
+
+        input1, input2, output = data['input1'], data['input2'], data['output']
+        from_left = output.base == input1.base
+        from_right = output.base == input2.base
+        records['record_id'].append(record_id)
+        records['name'].append(name)
+        records['iclass'].append(input1.iclass)
+        records['prefix_pool'].append(len(input1.getPrefixes()) + len(input2.getPrefixes()))
+        records['suffix_pool'].append(len(input1.getSuffixes()) + len(input2.getSuffixes()))
+        records['output_prefixes'].append(len(output.getPrefixes()))
+        records['output_suffixes'].append(len(output.getSuffixes()))
+        records['base_side'].append(0 if from_left and not from_right else 1 if from_right and not from_left else None)
+
+        kept_output_indices = {oidx for item in [input1, input2] for m in item.mods for _, oidx in m.kept}
+        for item_type in ITEM_TYPES:
+            item = data[item_type]
+            slots = [m.getSlot() for m in item.mods]
+            items['item_id'].append(item_id)
+            items['record_id'].append(record_id)
+            items['item_type'].append(item_type)
+            items['iclass'].append(item.iclass)
+            items['rarity'].append(item.rarity)
+            items['name'].append(item.name)
+            items['base'].append(item.base)
+            items['ilvl'].append(item.ilvl)
+            items['req_level'].append(item.req.level)
+            items['req_str'].append(item.req.str)
+            items['req_dex'].append(item.req.dex)
+            items['req_int'].append(item.req.int)
+            items['sockets'].append(item.sockets.short)
+            items['special_types'].append(list(item.special_types or []))
+            items['implicit_count'].append(slots.count('Implicit'))
+            items['prefix_count'].append(slots.count('Prefix'))
+            items['suffix_count'].append(slots.count('Suffix'))
+
+            for mod_index, m in enumerate(item.mods):
+                # doubled holds [input1 idx, input2 idx] pairs, kept holds [own idx, output idx]
+                other_index = 1 if item_type == 'input1' else 0
+                mods['record_id'].append(record_id)
+                mods['item_id'].append(item_id)
+                mods['item_type'].append(item_type)
+                mods['mod_index'].append(mod_index)
+                mods['slot'].append(slots[mod_index])
+                mods['category'].append(m.category)
+                mods['title'].append(m.title)
+                mods['tier'].append(m.tier)
+                mods['description'].append(m.stringDescription())
+                mods['tags'].append(list(m.tags))
+                mods['doubled'].append(bool(m.doubled))
+                mods['doubled_index'].append(m.doubled[0][other_index] if m.doubled else None)
+                mods['kept'].append(mod_index in kept_output_indices if item_type == 'output' else bool(m.kept))
+                mods['kept_index'].append(m.kept[0][1] if m.kept else None)
+                mods['repoe_mod_id'].append(m.repoe_mod_id)
+                mods['mod_group'].append(m.mod_group)
+            item_id += 1
+        record_id += 1
+
+    return records, items, mods
+
+
+def makeTable(columns, schema, metadata):
+    arrays = []
+    fields = []
+    for schema_field in schema:
+        array = pa.array(columns[schema_field.name], type=schema_field.type)
+        if schema_field.name in DICTIONARY_COLUMNS:
+            array = array.dictionary_encode()
+        arrays.append(array)
+        fields.append(pa.field(schema_field.name, array.type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields, metadata=metadata))
+
+
+def getTablePath(path, table_name, format):
+    return Path(path) / f'{table_name}.{format}'
+
+
+def exportColumnar(recombs, path=default_columnar_path, format='arrow'):
+    # Write the records/items/mods tables, replacing any previous export in either format
+    # Returns {table name: row count}
+    os.makedirs(path, exist_ok=True)
+    metadata = {
+        'columnar_version': str(COLUMNAR_VERSION),
+        'parse_version': getParseVersion(),
+    }
+    tables = {
+        table_name: makeTable(columns, schema, metadata)
+        for table_name, columns, schema in zip(TABLE_NAMES, flattenRecombs(recombs), [RECORD_SCHEMA, ITEM_SCHEMA, MOD_SCHEMA])
+    }
+
+    for table_name, table in tables.items():
+        table_path = getTablePath(path, table_name, format)
+        tmp_path = f'{table_path}.tmp'
+        if format == 'arrow':
+            # Uncompressed so loadColumnar can memory map it without copying
+            with pa.OSFile(tmp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        elif format == 'parquet':
+            pq.write_table(table, tmp_path)
+        else:
+            raise ValueError(f'Unknown columnar format "{format}"')
+        os.replace(tmp_path, table_path)
+
+        other_format = 'parquet' if format == 'arrow' else 'arrow'
+        if os.path.exists(getTablePath(path, table_name, other_format)):
+            os.remove(getTablePath(path, table_name, other_format))
+
+    return {table_name: table.num_rows for table_name, table in tables.items()}
+
+
+def readTable(path, table_name):
+    arrow_path = getTablePath(path, table_name, 'arrow')
+    if os.path.exists(arrow_path):
+        return pa.ipc.open_file(pa.memory_map(str(arrow_path), 'r')).read_all()
+    return pq.read_table(getTablePath(path, table_name, 'parquet'), memory_map=True)
+
+
+@dataclass
+class ColumnarCorpus:
+    records: pa.Table
+    items: pa.Table
+    mods: pa.Table
+
+    def getMeta(self, key):
+        value = (self.records.schema.metadata or {}).get(key.encode())
+        return None if value is None else value.decode()
+
+    def filterRecords(self, iclass=None, prefix_pool=None, suffix_pool=None):
+        # Vectorized filters, each one is a value or a list of allowed values
+        mask = None
+        for column, allowed in [('iclass', iclass), ('prefix_pool', prefix_pool), ('suffix_pool', suffix_pool)]:
+            if allowed is None:
+                continue
+            allowed = allowed if isinstance(allowed, (list, tuple, set)) else [allowed]
+            values = self.records[column]
+            if pa.types.is_dictionary(values.type):
+                values = values.cast(pa.string())
+            column_mask = pc.is_in(values, value_set=pa.array(list(allowed), type=values.type))
+            mask = column_mask if mask is None else pc.and_(mask, column_mask)
+        return self.records if mask is None else self.records.filter(mask)
+
+    def getItems(self, records=None, item_type=None):
+        # Items of the given records (a table from filterRecords, or every record), optionally only one item type
+        items = self.items
+        if records is not None:
+            items = items.filter(pc.is_in(items['record_id'], value_set=records['record_id'].combine_chunks()))
+        if item_type is not None:
+            items = items.filter(pc.equal(items['item_type'].cast(pa.string()), item_type))
+        return items
+
+    def getMods(self, records=None, item_type=None, slot=None):
+        mods = self.mods
+        if records is not None:
+            mods = mods.filter(pc.is_in(mods['record_id'], value_set=records['record_id'].combine_chunks()))
+        if item_type is not None:
+            mods = mods.filter(pc.equal(mods['item_type'].cast(pa.string()), item_type))
+        if slot is not None:
+            mods = mods.filter(pc.equal(mods['slot'].cast(pa.string()), slot))
+        return mods
+
+    def toPandas(self):
+        # {table name: DataFrame}, needs pandas
+        return {table_name: getattr(self, table_name).to_pandas() for table_name in TABLE_NAMES}
+
+
+def loadColumnar(path=default_columnar_path):
+    # Memory maps an Arrow export (Parquet exports are read in full), nothing is parsed
+    return ColumnarCorpus(*[readTable(path, table_name) for table_name in TABLE_NAMES])
+
+
+def isColumnarStale(path=default_columnar_path):
+    # Missing, from an older exporter, or parsed with a different parser/RePoE index than the current one
+    try:
+        columnar = loadColumnar(path)
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return True
+    return (
+        columnar.getMeta('columnar_version') != str(COLUMNAR_VERSION)
+        or columnar.getMeta('parse_version') != getParseVersion()
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the parsed corpus as columnar tables')
+    parser.add_argument('--output', type=Path, default=default_columnar_path)
+    parser.add_argument('--format', choices=['arrow', 'parquet'], default='arrow')
+    args = parser.parse_args()
+
+    from simulator import getCorpus
+    start = time.perf_counter()
+    row_counts = exportColumnar(getCorpus().recombs, args.output, args.format)
+    counts = ', '.join(f'{count} {table_name}' for table_name, count in row_counts.items())
+    cprint(f'Exported {counts} to {args.output} in {time.perf_counter() - start:.2f}s', 'green')
@@ -0,0 +1,117 @@
+import os
+import pickle
+from pathlib import Path
+
+from frequency_table import FrequencyTable
+from instrumentation import instrumentation
+from mod_identity import getModIdentityResolver
+from utils import annotateRecomb, countParseFailures, loadRecombsFromFileListParallel, parseRecombFile
+
+
+# Bump whenever PoEItem/PoEMod or the parsing logic changes, so stale pickles get thrown away
+CACHE_VERSION = 5
+default_cache_path = Path().parent / 'data/cache/recombs.pickle'
+
+# Below this many files to parse (eg a warm cache with a few new records) starting a process pool costs more than it saves
+PARALLEL_PARSE_THRESHOLD = 200
+
+
+def getParseVersion():
+    # Doubled/kept annotations depend on the RePoE index mods were resolved against, so it is part of the version
+    return f'{CACHE_VERSION}:{getModIdentityResolver().source}'
+
+
+def getFileSignature(full_fpath):
+    # Records are keyed by file name, size and mtime - if any of them change the record is re-parsed
+    st = os.stat(full_fpath)
+    return (full_fpath.name, st.st_size, st.st_mtime_ns)
+
+
+def readCache(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        # Corrupt or written by an incompatible version of the code
+        return None
+    if cache.get('version') != getParseVersion():
+        return None
+    return cache
+
+
+def writeCache(cache, cache_path):
+    # Write to a temp file first so an interrupted write never leaves a half-written cache behind
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def parseRecombFiles(recombination_files_full):
+    # {file name: parsed and annotated record}, across a process pool when there are enough files and cores
+    # Records that fail in a worker are parsed again here, so failures look exactly like they do serially
+    records = {}
+    remaining = recombination_files_full
+    if len(recombination_files_full) >= PARALLEL_PARSE_THRESHOLD and (os.cpu_count() or 1) > 1:
+        with instrumentation.timer('load.parse_parallel'):
+            records, errors = loadRecombsFromFileListParallel(recombination_files_full)
+        for record in records.values():
+            countParseFailures(record)
+        remaining = [full_fpath for full_fpath in recombination_files_full if full_fpath.name in errors]
+
+    for full_fpath in remaining:
+        with instrumentation.timer('load.parse'):
+            record = parseRecombFile(full_fpath)
+        countParseFailures(record)
+        with instrumentation.timer('load.annotate'):
+            annotateRecomb(record)
+        records[full_fpath.name] = record
+    return records
+
+
+def loadRecombsCached(recombination_files_full, cache_path=default_cache_path):
+    # Same records as loadRecombsFromFileList, plus the FrequencyTable built from them
+    # Only new or changed files are parsed and annotated, everything else comes from the pickle,
+    #   and the frequency table is updated by removing/adding just those records
+    cache = readCache(cache_path)
+    if cache is None:
+        cache = {'version': getParseVersion(), 'files': {}, 'frequency_table': FrequencyTable()}
+
+    cached_files = cache['files']
+    frequency_table = cache['frequency_table']
+
+    signatures = {full_fpath.name: getFileSignature(full_fpath) for full_fpath in recombination_files_full}
+    parsed = parseRecombFiles([
+        full_fpath for full_fpath in recombination_files_full
+        if cached_files.get(full_fpath.name, (None,))[0] != signatures[full_fpath.name]
+    ])
+
+    recombs = {}
+    dirty = False
+    for full_fpath in recombination_files_full:
+        fpath = full_fpath.name
+        cached = cached_files.get(fpath)
+        if fpath not in parsed:
+            recombs[fpath] = cached[1]
+        else:
+            if cached is not None:
+                frequency_table.removeRecord(fpath, cached[1])
+            record = parsed[fpath]
+            frequency_table.addRecord(fpath, record)
+            recombs[fpath] = record
+            cached_files[fpath] = (signatures[fpath], record)
+            dirty = True
+
+    # Drop records whose files were removed
+    for fpath in set(cached_files) - set(recombs):
+        frequency_table.removeRecord(fpath, cached_files[fpath][1])
+        del cached_files[fpath]
+        dirty = True
+
+    if dirty:
+        writeCache(cache, cache_path)
+
+    return recombs, frequency_table
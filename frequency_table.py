@@ -0,0 +1,61 @@
+from collections import Counter, defaultdict
+
+from utils import getRecordPoolSizes
+
+
+class FrequencyTable:
+    # Incremental version of before_after/bafreq
+    # counts[input pool size][output pool size] = number of observations
+    # bafreq is updated in place, row by row, so every module holding a reference to it sees new records immediately
+    def __init__(self, bafreq=None):
+        self.counts = defaultdict(Counter)
+        self.records = set()
+        self.bafreq = {} if bafreq is None else bafreq
+
+    @classmethod
+    def fromRecombs(cls, recombs):
+        table = cls()
+        for fpath, data in recombs.items():
+            table.addRecord(fpath, data)
+        return table
+
+    def refreshRow(self, in_pool):
+        # Same rounding as utils.calculateBaFreq
+        freq = self.counts[in_pool]
+        total = freq.total()
+        if total == 0:
+            del self.counts[in_pool]
+            self.bafreq.pop(in_pool, None)
+        else:
+            self.bafreq[in_pool] = {outcome: round(num/total,  3) for outcome, num in freq.items() if num > 0}
+
+    def addObservation(self, in_pool, out_pool, count=1):
+        self.counts[in_pool][out_pool] += count
+        if self.counts[in_pool][out_pool] <= 0:
+            del self.counts[in_pool][out_pool]
+        self.refreshRow(in_pool)
+
+    def addRecord(self, fpath, data):
+        # Adding a record twice is a no-op, so re-recording the same file can't skew the table
+        if fpath in self.records:
+            return False
+        for in_pool, out_pool in getRecordPoolSizes(data):
+            self.addObservation(in_pool, out_pool)
+        self.records.add(fpath)
+        return True
+
+    def removeRecord(self, fpath, data):
+        if fpath not in self.records:
+            return False
+        for in_pool, out_pool in getRecordPoolSizes(data):
+            self.addObservation(in_pool, out_pool, count=-1)
+        self.records.remove(fpath)
+        return True
+
+    def getBeforeAfter(self):
+        # Same shape as utils.calculateBeforeAfter (list of output sizes per input size), grouped by outcome
+        before_after = defaultdict(list)
+        for in_pool in sorted(self.counts):
+            for out_pool, num in self.counts[in_pool].items():
+                before_after[in_pool].extend([out_pool] * num)
+        return before_after
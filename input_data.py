@@ -1,10 +1,13 @@
-import json
-import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from termcolor import cprint
 
-from simulator import recombineItems, pprintRecombinatorOutcomes, ValuableMod
+from recomb_store import openRecombStore
+from service import SimulatorClient, isServiceRunning, recombineItemsRemote
+from simulator import addRecordedRecomb, getCorpus, recombineItems, pprintRecombinatorOutcomes, renderRecombOutcomes
 from utils import parseItem
+from valuable import ValuableMod, compileValuableMods
 
 
 def getUntilEOF():
@@ -17,8 +20,40 @@ def getUntilEOF():
     return lines
 
 
+def printPreview(future, item1, item2, valuable_mods):
+    # Runs on the background thread once the simulation is done, the main thread is waiting on input() by then
+    try:
+        output_to_percent = future.result()
+    except Exception as e:
+        cprint(f'Preview failed: {e}', 'red')
+        return
+    pprintRecombinatorOutcomes(
+        output_to_percent,
+        (
+            item1.getValuableCount(valuable_mods),
+            item2.getValuableCount(valuable_mods),
+        ),
+        compression_level=3
+    )
+
+
+def printRemotePreview(future):
+    # Same as printPreview for a preview simulated by the service
+    try:
+        _, summary = future.result()
+    except Exception as e:
+        cprint(f'Preview failed: {e}', 'red')
+        return
+    renderRecombOutcomes(summary, 3)
+
+
 if __name__ == '__main__':
-    valuable_mods = [
+    parser = argparse.ArgumentParser(description='Record recombinations into the recomb store')
+    parser.add_argument('--preview', action='store_true', help='Simulate each pair in the background while the output is pasted')
+    parser.add_argument('--service', nargs='?', const='data/simulator.sock', default=None, help='Preview and share recorded recombs with a running service.py (socket path)')
+    args = parser.parse_args()
+
+    valuable_mods = compileValuableMods([
         ValuableMod('X% increased Physical Damage|+X to Accuracy Rating', 4),
         ValuableMod('X% increased Physical Damage', 3),
         ValuableMod('Socketed Gems are supported by Level X Multistrike — Unscalable Value|X% increased Attack Speed', 2),
@@ -30,14 +65,22 @@ if __name__ == '__main__':
         ValuableMod('Socketed Gems are Supported by Level X Brutality — Unscalable Value|X% increased Physical Damage', 1),
         ValuableMod('Socketed Gems are Supported by Level X Melee Physical Damage — Unscalable Value|X% increased Physical Damage', 1),
         ValuableMod('Socketed Gems are Supported by Level X Ruthless — Unscalable Value|X% increased Physical Damage', 1)
-    ]
+    ])
     
-    existing_json_files = sorted(os.listdir('data/json'))
-    if existing_json_files:
-        max_count_fname = existing_json_files[-1]
-        max_count = int(max_count_fname.split('.')[0])
-    else:
-        max_count = 0
+    store = openRecombStore()
+
+    # The corpus is only needed for previews and for addRecordedRecomb, so it loads in the background
+    #   while the first items are pasted instead of delaying the first prompt
+    # With --service the service's already warm corpus is used instead, and is sent every new recomb
+    background = ThreadPoolExecutor(max_workers=1)
+    client = None
+    if args.service is not None:
+        if isServiceRunning(args.service):
+            client = SimulatorClient(args.service)
+        else:
+            cprint(f'No service running on {args.service}, simulating locally', 'red')
+    if args.preview and client is None:
+        background.submit(getCorpus)
 
     while True:
         # Get user data
@@ -50,25 +93,23 @@ if __name__ == '__main__':
         item1 = parseItem(input1, 'REPL')
         item2 = parseItem(input2, 'REPL')
         
-        # output_to_percent = recombineItems(item1, item2, valuable_mods)
-        # pprintRecombinatorOutcomes(
-        #     output_to_percent,
-        #     (
-        #         item1.getValuableCount(valuable_mods),
-        #         item2.getValuableCount(valuable_mods),
-        #     ),
-        #     compression_level=3
-        # )
+        if args.preview and item1 is not None and item2 is not None and client is not None:
+            # The client is only used from the background thread
+            future = background.submit(recombineItemsRemote, input1, input2, valuable_mods, client=client)
+            future.add_done_callback(printRemotePreview)
+        elif args.preview and item1 is not None and item2 is not None:
+            future = background.submit(recombineItems, item1, item2, valuable_mods)
+            future.add_done_callback(lambda future, item1=item1, item2=item2: printPreview(future, item1, item2, valuable_mods))
         
         cprint('-----------------------------------------------------------------------------', 'yellow')
         cprint('Output (Alt+Ctrl+C -> Ctrl+V -> Ctrl+D):', 'yellow')
         output = getUntilEOF()
         cprint('-----------------------------------------------------------------------------', 'red')
 
-        # Store in JSON file (for now)
-        storage_fname = f'data/json/{str(max_count+1).zfill(5)}.json'
-        with open(storage_fname, 'w') as f:
-            json.dump({'input1': input1, 'input2': input2, 'output': output}, f, indent=2)
-        
-        max_count += 1
-        
\ No newline at end of file
+        # Append to the recomb store, ids continue the old data/json numbering
+        # addRecordedRecomb is a no-op until the corpus is loaded, which then reads this record from the store
+        name, record = store.addRecomb(input1, input2, output)
+        if record is not None:
+            addRecordedRecomb(name, record)
+            if client is not None:
+                background.submit(client.call, 'add_recomb', name=name, input1=input1, input2=input2, output=output)
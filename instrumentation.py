@@ -0,0 +1,74 @@
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+from termcolor import cprint
+
+
+# Opt-in stage timers and counters for the simulator and loader
+# Turn on with POE_RECOMB_INSTRUMENT=1 or instrumentation.enable(), read back with getReport()/pprintReport()
+# When disabled, timer() hands back a shared no-op context and count() returns straight away
+
+null_timer = nullcontext()
+
+
+class StageTimer:
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.timers[self.stage] += time.perf_counter() - self.start
+        self.instrumentation.timer_calls[self.stage] += 1
+        return False
+
+
+class Instrumentation:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timers = defaultdict(float) # stage -> total seconds
+        self.timer_calls = Counter() # stage -> number of timed sections
+        self.counters = Counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.timers.clear()
+        self.timer_calls.clear()
+        self.counters.clear()
+
+    def timer(self, stage):
+        if not self.enabled:
+            return null_timer
+        return StageTimer(self, stage)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def getReport(self):
+        return {
+            'timers': {stage: {'seconds': seconds, 'calls': self.timer_calls[stage]} for stage, seconds in self.timers.items()},
+            'counters': dict(self.counters),
+        }
+
+    def pprintReport(self):
+        for stage, seconds in sorted(self.timers.items(), key=lambda x: x[1], reverse=True):
+            calls = self.timer_calls[stage]
+            print(f'{stage.ljust(40)} {seconds*1000:10.2f}ms  {str(calls).rjust(8)} calls  {seconds/calls*1e6:10.1f}us/call')
+        for name, value in sorted(self.counters.items()):
+            print(f'{name.ljust(40)} {value}')
+        if not self.timers and not self.counters:
+            cprint('Nothing recorded, is instrumentation enabled?', 'yellow')
+
+
+instrumentation = Instrumentation(enabled=os.environ.get('POE_RECOMB_INSTRUMENT', '') not in ['', '0'])
@@ -0,0 +1,108 @@
+import argparse
+import traceback
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+from termcolor import cprint
+
+from poe_types import PoEItem
+from utils import ITEM_CLASS_RE, SEPARATOR, parseItem
+
+
+# Streaming reader for text dumps of many concatenated Ctrl+Alt+C copies (eg a stash dump, or proto/ctrlaltc.txt)
+# Items are split on their "Item Class:" line and parsed one at a time as the dump is read, so only the current
+#   item's lines are ever held in memory no matter how big the dump is
+#
+# python item_stream.py stash.txt        parse a dump and report every item that fails
+
+
+@dataclass
+class ItemParseError:
+    index: int # Item number within the dump, counting failed items
+    line_number: int # 1-based line of the item's "Item Class:" line
+    name: str
+    error: str # Formatted exception
+    lines: list[str]
+
+
+@dataclass
+class ParsedItem:
+    # One per item in the dump, exactly one of item/error is set
+    index: int
+    line_number: int
+    item: PoEItem = None
+    error: ItemParseError = None
+
+
+def iterItemBlocks(lines):
+    # Yields (line number, item lines) for every item in an iterable of lines (a file object works)
+    # Anything before the first "Item Class:" line is skipped, blank lines around items are dropped
+    block = []
+    block_line_number = 0
+    for line_number, line in enumerate(lines, start=1):
+        line = line.rstrip('\r\n')
+        if ITEM_CLASS_RE.match(line):
+            if block:
+                yield block_line_number, trimBlankLines(block)
+            block = [line]
+            block_line_number = line_number
+        elif block:
+            block.append(line)
+    if block:
+        yield block_line_number, trimBlankLines(block)
+
+
+def trimBlankLines(lines):
+    end = len(lines)
+    while end > 0 and not lines[end - 1].strip():
+        end -= 1
+    return lines[:end]
+
+
+def iterParsedItems(lines, file_from='dump'):
+    # Yields a ParsedItem per item, failures carry an ItemParseError instead of printing a traceback
+    for index, (line_number, block) in enumerate(iterItemBlocks(lines)):
+        try:
+            item = parseItem(block, file_from, raise_errors=True)
+        except Exception as e:
+            name = block[2] if len(block) > 3 and block[3] != SEPARATOR else ''
+            error = ItemParseError(index, line_number, name, ''.join(traceback.format_exception(e)), block)
+            yield ParsedItem(index, line_number, error=error)
+            continue
+        yield ParsedItem(index, line_number, item=item)
+
+
+def iterItems(lines, file_from='dump', errors=None):
+    # Yields only the PoEItems, failed items are appended to errors if given (a list) and skipped either way
+    for parsed in iterParsedItems(lines, file_from):
+        if parsed.error is None:
+            yield parsed.item
+        elif errors is not None:
+            errors.append(parsed.error)
+
+
+def iterItemsFromFile(path, errors=None):
+    # Same as iterItems over a dump file, read lazily line by line
+    with open(path, 'r', encoding='utf-8') as f:
+        yield from iterItems(f, Path(path).name, errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse a text dump of concatenated Ctrl+Alt+C item copies')
+    parser.add_argument('path', type=Path)
+    parser.add_argument('--verbose', action='store_true', help='Print full tracebacks for failed items')
+    args = parser.parse_args()
+
+    errors = []
+    item_classes = Counter()
+    for item in iterItemsFromFile(args.path, errors):
+        item_classes[item.iclass] += 1
+
+    cprint(f'Parsed {sum(item_classes.values())} items from {args.path}', 'green')
+    for iclass, count in item_classes.most_common():
+        print(f'    {count:5d} {iclass}')
+    for error in errors:
+        cprint(f'Item {error.index} "{error.name}" (line {error.line_number}) failed: {error.error.strip().splitlines()[-1]}', 'red')
+        if args.verbose:
+            cprint(error.error, 'red')
@@ -0,0 +1,117 @@
+import hashlib
+
+from mod_intern import ModInternTable
+
+
+# Modgroup-aware mod identity
+# Parsed mods are resolved to RePoE mod ids and groups through repoe_index, the same way as convertItemModsToId in
+#   RePoE.ipynb (generic text, then slot and mod title to narrow down the candidates)
+# Every mod gets an integer identity: its interned mod group when that resolves, otherwise its interned description,
+#   so without a RePoE index identities behave exactly like description comparisons
+
+# ('group', group) or ('description', description) -> int, only stable within one process
+mod_identity_table = ModInternTable()
+
+# Bump whenever resolveUncached changes, it is part of the resolver source so records parsed with older rules re-parse
+RESOLVE_VERSION = 2
+
+# Source markers parsed descriptions carry at the end of each line, RePoE texts don't have them
+MOD_TEXT_SOURCE_SUFFIXES = [' (crafted)', ' (implicit)', ' (fractured)']
+
+
+def getGenericModText(description):
+    # Description without its source markers, the form repoe_index keys its mods by
+    lines = description.split('\n')
+    for suffix in MOD_TEXT_SOURCE_SUFFIXES:
+        lines = [l[:-len(suffix)] if l.endswith(suffix) else l for l in lines]
+    return '\n'.join(lines)
+
+
+def isCraftedDescription(description):
+    return any(l.endswith(' (crafted)') for l in description.split('\n'))
+
+
+class ModIdentityResolver:
+    def __init__(self, index=None):
+        self.index = index
+        self.resolved = {} # (description, tier, category, title) -> (RePoE mod id or None, group or None)
+        if index is None:
+            self.source = 'descriptions'
+        else:
+            signature = index.getMeta('source_signature') or ''
+            self.source = 'repoe-' + hashlib.sha1(f'{RESOLVE_VERSION}:{index.getMeta("version")}:{signature}'.encode()).hexdigest()[:12]
+
+    def resolve(self, description, tier, category, title):
+        key = (description, tier, category, title)
+        if key not in self.resolved:
+            self.resolved[key] = self.resolveUncached(description, tier, category, title)
+        return self.resolved[key]
+
+    def resolveUncached(self, description, tier, category, title):
+        if self.index is None:
+            return (None, None)
+        candidates = self.index.getModsForText(getGenericModText(description))
+
+        # The group only depends on the text and the slot, never on the tier or title, so every mod with this text
+        #   gets the same kind of identity (always its group or always its description) whatever item it came from
+        # The slot filter only applies when it leaves something, RePoE generation types aren't complete
+        slot_candidates = [c for c in candidates if category is not None and c.generation_type in category.lower()]
+        candidates = slot_candidates or candidates
+        groups = {tuple(c.groups) for c in candidates}
+        group = '|'.join(groups.pop()) if len(groups) == 1 and groups != {()} else None
+
+        # The mod id additionally has to fit the title and the tier, otherwise it stays unknown
+        titled = [c for c in candidates if title != '' and c.name == title]
+        if group is None:
+            # Tiers are only comparable within one group, so narrow down to the group of the titled candidates
+            titled_groups = {tuple(c.groups) for c in titled}
+            if len(titled_groups) == 1:
+                candidates = [c for c in candidates if tuple(c.groups) in titled_groups]
+            elif len(candidates) != 1:
+                return (None, None)
+        # Crafted mods have no tier and aren't part of the tiers of their group
+        crafted = isCraftedDescription(description)
+        tiers = [c for c in candidates if (c.domain == 'crafted') == crafted] or candidates
+        # Tier 1 has the highest level requirement
+        by_level = sorted(tiers, key=lambda c: c.required_level or 0, reverse=True)
+        if tier:
+            fits = tier <= len(by_level) and (not titled or by_level[tier - 1].name == title)
+            return (by_level[tier - 1].mod_id if fits else None, group)
+        # No tier on the item (crafted mods, implicits), only a single match is accepted
+        matching = [c for c in by_level if title != '' and c.name == title] or by_level
+        return (matching[0].mod_id if len(matching) == 1 else None, group)
+
+mod_identity_resolver = None
+
+
+def getModIdentityResolver():
+    # Uses data/repoe_index.sqlite when it exists (or can be built), see repoe_index.openRePoEIndex
+    global mod_identity_resolver
+    if mod_identity_resolver is None:
+        from repoe_index import openRePoEIndex # repoe_index imports utils, which imports this module
+        mod_identity_resolver = ModIdentityResolver(openRePoEIndex())
+    return mod_identity_resolver
+
+
+def setModIdentityResolver(resolver):
+    # Swap the resolver, eg ModIdentityResolver() to force description identities
+    # Mods that were already resolved keep their identity, so call this before loading anything
+    global mod_identity_resolver
+    mod_identity_resolver = resolver
+
+
+def resolveMod(mod):
+    repoe_mod_id, group = getModIdentityResolver().resolve(mod.stringDescription(), mod.tier, mod.category, mod.title)
+    mod.repoe_mod_id = repoe_mod_id
+    mod.mod_group = group
+    if group is None:
+        mod.identity = mod_identity_table.intern(('description', mod.stringDescription()))
+    else:
+        mod.identity = mod_identity_table.intern(('group', group))
+
+
+def getModIdentity(mod):
+    # Integer identity used to compare mods across items (doubling, kept detection, distinct pools)
+    if mod.identity is None:
+        resolveMod(mod)
+    return mod.identity
@@ -0,0 +1,78 @@
+from poe_types import PoEMod
+
+
+# Slot codes used by CompactMod
+SLOT_CODES = {'Implicit': 0, 'Prefix': 1, 'Suffix': 2}
+
+
+class ModInternTable:
+    # Gives every distinct key (the description unless another key is given) a small integer id, in first seen order
+    #   descriptions holds the first description seen for each id
+    # Ids are only stable within one process, so they should never be written to disk
+    def __init__(self):
+        self.ids = {}
+        self.descriptions = []
+
+    def intern(self, description, key=None):
+        key = description if key is None else key
+        mod_id = self.ids.get(key)
+        if mod_id is None:
+            mod_id = len(self.descriptions)
+            self.ids[key] = mod_id
+            self.descriptions.append(description)
+        return mod_id
+
+    def getDescription(self, mod_id):
+        return self.descriptions[mod_id]
+
+    def __len__(self):
+        return len(self.descriptions)
+
+
+mod_intern_table = ModInternTable()
+JUNK_PREFIX_ID = mod_intern_table.intern('Junk Prefix')
+JUNK_SUFFIX_ID = mod_intern_table.intern('Junk Suffix')
+
+
+class CompactMod:
+    # Small record for hot loops: interned mod id, slot code and tier
+    # mod keeps a reference to the PoEMod it came from so it can be turned back into one for display
+    __slots__ = ('mod_id', 'slot', 'tier', 'mod')
+
+    def __init__(self, mod_id, slot, tier, mod=None):
+        self.mod_id = mod_id
+        self.slot = slot
+        self.tier = tier
+        self.mod = mod
+
+    def __repr__(self):
+        return f'CompactMod({mod_intern_table.getDescription(self.mod_id)!r}, slot={self.slot}, tier={self.tier})'
+
+
+def compactMod(mod):
+    # Mods are interned by identity (mod group, or description when no group resolves), see mod_identity
+    identity = mod.identity
+    if identity is None:
+        from mod_identity import getModIdentity # mod_identity imports this module
+        identity = getModIdentity(mod)
+    return CompactMod(
+        mod_intern_table.intern(mod.stringDescription(), ('identity', identity)),
+        SLOT_CODES.get(mod.getSlot()),
+        mod.tier,
+        mod,
+    )
+
+
+def compactMods(mods):
+    return [compactMod(m) for m in mods]
+
+
+def expandCompactMod(compact_mod, junk_prefix_dict, junk_suffix_dict):
+    # Back to a PoEMod, junk ids become the usual junk placeholder mods
+    if compact_mod.mod is not None:
+        return compact_mod.mod
+    if compact_mod.mod_id == JUNK_PREFIX_ID:
+        return PoEMod(**junk_prefix_dict)
+    if compact_mod.mod_id == JUNK_SUFFIX_ID:
+        return PoEMod(**junk_suffix_dict)
+    raise ValueError(f'{compact_mod} has no source PoEMod')
@@ -0,0 +1,173 @@
+import math
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from mod_identity import getModIdentity
+from poe_types import PoEMod
+from simulator import getBaFreq, getCorpus, getStateSortKey, getValuablePoolIndices, junk_prefix_dict, junk_suffix_dict
+from valuable import compileValuableMods
+
+
+@dataclass
+class DoublingWeights:
+    # Relative weight of a mod present on both inputs vs one present on a single input, when picking output mods
+    doubled: float = 1.0
+    single: float = 1.0
+    # Raw counts the weights were learned from
+    doubled_kept: int = 0
+    doubled_total: int = 0
+    single_kept: int = 0
+    single_total: int = 0
+
+
+def learnDoublingWeights(recombs=None):
+    # Keep rates from the doubled/kept annotations of utils.annotateRecomb, over the whole corpus by default
+    # A doubled mod is counted once (from input1), since both copies collapse into a single output mod
+    if recombs is None:
+        recombs = getCorpus().recombs
+    counts = Counter()
+    for data in recombs.values():
+        for item_type in ['input1', 'input2']:
+            for m in data[item_type].getAffixes():
+                if m.doubled:
+                    if item_type == 'input2':
+                        continue
+                    kind = 'doubled'
+                else:
+                    kind = 'single'
+                counts[f'{kind}_total'] += 1
+                counts[f'{kind}_kept'] += len(m.kept) > 0
+
+    weights = DoublingWeights(**counts)
+    if weights.doubled_total > 0 and weights.single_total > 0 and weights.single_kept > 0:
+        weights.doubled = (weights.doubled_kept / weights.doubled_total) / (weights.single_kept / weights.single_total)
+    return weights
+
+
+@dataclass
+class MonteCarloResult:
+    output_to_percent: Counter
+    intervals: dict = field(default_factory=dict) # state -> (low, high)
+    samples: int = 0
+    converged: bool = False
+
+
+def getDistinctPool(mod_pool, valuable_mods, doubling_weights, mod_weights):
+    # Collapse mods with the same identity (doubled mods, see mod_identity) into one entry
+    # Returns [(representative PoEMod, is_valuable, weight)] in first seen order, mod_weights are keyed by description
+    groups = defaultdict(list)
+    for i, m in enumerate(mod_pool):
+        groups[getModIdentity(m)].append(i)
+
+    valuable_pool_indices = set(getValuablePoolIndices(mod_pool, valuable_mods))
+    distinct = []
+    for indices in groups.values():
+        valuable = [i for i in indices if i in valuable_pool_indices]
+        representative = mod_pool[valuable[0] if valuable else indices[0]]
+        weight = doubling_weights.doubled if len(indices) > 1 else doubling_weights.single
+        weight *= mod_weights.get(representative.stringDescription(), 1.0)
+        distinct.append((representative, len(valuable) > 0, weight))
+    return distinct
+
+
+def samplePool(rng, batch_size, distinct, pool_freq):
+    # Draw output sizes from bafreq, then pick that many distinct mods per sample with weighted sampling without
+    #   replacement (smallest exponential keys with rate = weight), all as array operations
+    # Output sizes bigger than the distinct pool have no outcome, like in the exact engines their mass is dropped:
+    #   those samples are flagged invalid and the caller discards them (they still count towards the sample total)
+    # Returns (valuable bitmask per sample, junk count per sample, valid per sample)
+    sizes = np.array(list(pool_freq.keys()))
+    probs = np.array(list(pool_freq.values()), dtype=float)
+    output_sizes = rng.choice(sizes, size=batch_size, p=probs / probs.sum())
+    valid = output_sizes <= len(distinct)
+
+    if len(distinct) == 0:
+        return np.zeros(batch_size, dtype=np.int64), np.zeros(batch_size, dtype=np.int64), valid
+
+    weights = np.array([w for _, _, w in distinct])
+    keys = rng.exponential(size=(batch_size, len(distinct))) / weights
+    ranks = keys.argsort(axis=1).argsort(axis=1)
+    chosen = ranks < output_sizes[:, None]
+
+    valuable_flags = np.array([is_valuable for _, is_valuable, _ in distinct])
+    valuable_positions = np.cumsum(valuable_flags) - 1
+    bit_values = np.where(valuable_flags, 2 ** np.maximum(valuable_positions, 0), 0).astype(np.int64)
+    valuable_bits = (chosen * bit_values).sum(axis=1)
+    junk_counts = (chosen & ~valuable_flags).sum(axis=1)
+    return valuable_bits, junk_counts, valid
+
+
+def recombineItemsMonteCarlo(
+    item1,
+    item2,
+    valuable_mods,
+    seed=None,
+    batch_size=10000,
+    max_samples=1000000,
+    precision=0.005,
+    z=1.96,
+    doubling_weights=None,
+    mod_weights=None,
+):
+    # Sampling counterpart to recombineItems that also models doubled mods and per mod weights
+    # Output states use the same compressed format, but doubled mods show up once
+    # Sampling stops once every state's confidence interval half-width (normal approximation, z) is below precision
+    rng = np.random.default_rng(seed)
+    valuable_mods = compileValuableMods(valuable_mods)
+    doubling_weights = doubling_weights or DoublingWeights()
+    mod_weights = mod_weights or {}
+
+    input_pools = {
+        'Prefix': item1.getPrefixes() + item2.getPrefixes(),
+        'Suffix': item1.getSuffixes() + item2.getSuffixes(),
+    }
+    distinct_pools = {
+        pool_type: getDistinctPool(mod_pool, valuable_mods, doubling_weights, mod_weights)
+        for pool_type, mod_pool in input_pools.items()
+    }
+
+    bafreq = getBaFreq()
+    counts = Counter()
+    samples = 0
+    converged = False
+    while samples < max_samples:
+        n = min(batch_size, max_samples - samples)
+        codes = [rng.integers(0, 2, size=n)]
+        valid = np.ones(n, dtype=bool)
+        for pool_type, mod_pool in input_pools.items():
+            valuable_bits, junk_counts, pool_valid = samplePool(rng, n, distinct_pools[pool_type], bafreq[len(mod_pool)])
+            codes.extend([valuable_bits, junk_counts])
+            valid &= pool_valid
+
+        unique_codes, unique_counts = np.unique(np.stack(codes, axis=1)[valid], axis=0, return_counts=True)
+        for code, count in zip(unique_codes.tolist(), unique_counts.tolist()):
+            counts[tuple(code)] += count
+        samples += n
+
+        max_half_width = max((z * math.sqrt(c / samples * (1 - c / samples) / samples) for c in counts.values()), default=0)
+        if max_half_width < precision:
+            converged = True
+            break
+
+    def materializePool(pool_type, valuable_bits, junk_count, junk_dict):
+        valuable_reps = [rep for rep, is_valuable, _ in distinct_pools[pool_type] if is_valuable]
+        kept_mods = [rep for i, rep in enumerate(valuable_reps) if valuable_bits >> i & 1]
+        junk_mods = [PoEMod(**junk_dict) for _ in range(junk_count)]
+        return tuple(sorted(kept_mods + junk_mods, key=getStateSortKey))
+
+    result = MonteCarloResult(Counter(), samples=samples, converged=converged)
+    for (item_base_index, prefix_bits, prefix_junk, suffix_bits, suffix_junk), count in counts.items():
+        compressed_state = (
+            item_base_index,
+            materializePool('Prefix', prefix_bits, prefix_junk, junk_prefix_dict),
+            materializePool('Suffix', suffix_bits, suffix_junk, junk_suffix_dict),
+        )
+        result.output_to_percent[compressed_state] += count / samples
+
+    for compressed_state, p in result.output_to_percent.items():
+        half_width = z * math.sqrt(p * (1 - p) / samples)
+        result.intervals[compressed_state] = (max(0, p - half_width), min(1, p + half_width))
+
+    return result
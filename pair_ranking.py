@@ -0,0 +1,131 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from recomb_queries import getLevel3Chances
+from simulator import check_recombineItems, getBaFreq, getLevel3Outcomes, getValuablePoolIndices, recombineItems, recombineItemsCompact
+from valuable import compileValuableMods
+
+
+@dataclass
+class PairScore:
+    left_index: int
+    right_index: int
+    p_gain: float
+    p_stay: float
+    p_lose: float
+    p_brick: float
+
+
+# Set per worker by initRankingWorker, so items are pickled once per worker instead of once per pair
+worker_items = None
+worker_valuable_mods = None
+worker_engine = None
+
+
+def initRankingWorker(items, valuable_mods, engine):
+    global worker_items, worker_valuable_mods, worker_engine
+    worker_items = items
+    worker_valuable_mods = valuable_mods
+    worker_engine = engine
+
+
+def getMaxGainBound(item1, item2, valuable_mods):
+    # Upper bound on how many valuable mods the output can hold minus the best input, without enumerating anything
+    # If this is <= 0 the pair can never land in the "gain mods" category
+    bafreq = getBaFreq()
+    valuable_bound = 0
+    for mod_pool in [item1.getPrefixes() + item2.getPrefixes(), item1.getSuffixes() + item2.getSuffixes()]:
+        if len(mod_pool) not in bafreq:
+            return None
+        valuable_count = len(getValuablePoolIndices(mod_pool, valuable_mods))
+        max_output = max([N for N, pc in bafreq[len(mod_pool)].items() if pc > 0], default=0)
+        valuable_bound += min(valuable_count, max_output)
+
+    best_input = max(item1.getValuableCount(valuable_mods), item2.getValuableCount(valuable_mods))
+    return valuable_bound - best_input
+
+
+def scoreRecombPair(pair):
+    left_index, right_index = pair
+    item1 = worker_items[left_index]
+    item2 = worker_items[right_index]
+
+    if worker_engine == 'closed_form':
+        # Category totals straight from the valuable count distribution, no states at all
+        level3_outcomes = getLevel3Chances(item1, item2, worker_valuable_mods)
+        return PairScore(
+            left_index = left_index,
+            right_index = right_index,
+            p_gain = level3_outcomes['green'],
+            p_stay = level3_outcomes['yellow'],
+            p_lose = level3_outcomes['red'],
+            p_brick = level3_outcomes['BRICK'],
+        )
+
+    if worker_engine == 'compact':
+        # Ranking only needs category totals, so the interned id states are enough
+        output_to_percent = recombineItemsCompact(item1, item2, worker_valuable_mods)
+    else:
+        output_to_percent = recombineItems(item1, item2, worker_valuable_mods, engine=worker_engine)
+    level3_outcomes = getLevel3Outcomes(
+        output_to_percent,
+        (
+            item1.getValuableCount(worker_valuable_mods),
+            item2.getValuableCount(worker_valuable_mods),
+        ),
+    )
+    return PairScore(
+        left_index = left_index,
+        right_index = right_index,
+        p_gain = level3_outcomes['green'],
+        p_stay = level3_outcomes['yellow'],
+        p_lose = level3_outcomes['red'],
+        p_brick = level3_outcomes['BRICK'],
+    )
+
+
+def scoreRecombPairs(pairs, items, valuable_mods, engine, max_workers, chunksize):
+    if max_workers == 1:
+        initRankingWorker(items, valuable_mods, engine)
+        return [scoreRecombPair(pair) for pair in pairs]
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=initRankingWorker,
+        initargs=(items, valuable_mods, engine),
+    ) as executor:
+        return list(executor.map(scoreRecombPair, pairs, chunksize=chunksize))
+
+
+def rankRecombPairs(items, valuable_mods, top_k=20, engine='compact', max_workers=None, chunksize=64):
+    # Score every viable pair in items and return the top_k PairScores, best P(gain) first, then lowest P(brick)
+    # Also returns a list of (left_index, right_index, reason) for pairs that could not be evaluated
+    valuable_mods = compileValuableMods(valuable_mods)
+    skipped = []
+    can_gain = []
+    cannot_gain = []
+    for left_index, right_index in itertools.combinations(range(len(items)), 2):
+        item1 = items[left_index]
+        item2 = items[right_index]
+        ok, reason = check_recombineItems(item1, item2, valuable_mods)
+        if not ok:
+            skipped.append((left_index, right_index, reason))
+            continue
+
+        gain_bound = getMaxGainBound(item1, item2, valuable_mods)
+        if gain_bound is None:
+            skipped.append((left_index, right_index, 'No recorded recombs for this pool size'))
+        elif gain_bound > 0:
+            can_gain.append((left_index, right_index))
+        else:
+            cannot_gain.append((left_index, right_index))
+
+    rank_key = lambda score: (-score.p_gain, score.p_brick)
+    scores = scoreRecombPairs(can_gain, items, valuable_mods, engine, max_workers, chunksize)
+
+    # Pairs that can't gain mods always rank below ones that do, so only score them if top_k isn't filled yet
+    if len([score for score in scores if score.p_gain > 0]) < top_k and cannot_gain:
+        scores.extend(scoreRecombPairs(cannot_gain, items, valuable_mods, engine, max_workers, chunksize))
+
+    return sorted(scores, key=rank_key)[:top_k], skipped
@@ -0,0 +1,238 @@
+import itertools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from simulator import annulState, getBaFreq, getPoolOutcomeVectors, getValuablePoolIndices, splitState
+
+
+# Non recomb helper crafting methods (same numbers as simulator.ipynb)
+C_PER_D = 185
+COST_YELLOWBEAST_D = 1 / 48 # Redtarget000 pricing
+COST_FENUMAL_PLAGUED_C = 8
+COST_ANNUL_C = 2
+COST_SPLIT_C = COST_YELLOWBEAST_D * 3 * C_PER_D + COST_FENUMAL_PLAGUED_C
+
+# Restart values above this are treated as "never succeeds"
+UNREACHABLE_COST_C = 1e9
+
+
+# Planner states are items compressed the same way as recombineItems output, minus the base:
+#   (sorted valuable prefix descriptions, junk prefix count, sorted valuable suffix descriptions, junk suffix count)
+def stateFromItem(item, valuable_mods):
+    pools = []
+    for mod_pool in [item.getPrefixes(), item.getSuffixes()]:
+        valuables = [mod_pool[i].stringDescription() for i in getValuablePoolIndices(mod_pool, valuable_mods)]
+        pools.extend([tuple(sorted(valuables)), len(mod_pool) - len(valuables)])
+    return tuple(pools)
+
+
+def stateFromCompressed(compressed_state):
+    # compressed_state is a key of recombineItems output: (item_base_index, prefix mods, suffix mods)
+    pools = []
+    for mod_pool in compressed_state[1:]:
+        descriptions = [m.stringDescription() for m in mod_pool]
+        valuables = [d for d in descriptions if not d.startswith('Junk')]
+        pools.extend([tuple(sorted(valuables)), len(descriptions) - len(valuables)])
+    return tuple(pools)
+
+
+def stateSatisfies(state, target):
+    have = Counter(state[0] + state[2])
+    return all(have[description] >= count for description, count in target.items())
+
+
+def getStateMods(state):
+    # Flatten into [(slot, description or None for junk)]
+    prefix_valuables, prefix_junk, suffix_valuables, suffix_junk = state
+    return (
+        [('Prefix', d) for d in prefix_valuables] + [('Prefix', None)] * prefix_junk
+        + [('Suffix', d) for d in suffix_valuables] + [('Suffix', None)] * suffix_junk
+    )
+
+
+def stateFromMods(mods):
+    pools = []
+    for slot in ['Prefix', 'Suffix']:
+        slot_mods = [d for s, d in mods if s == slot]
+        valuables = [d for d in slot_mods if d is not None]
+        pools.extend([tuple(sorted(valuables)), len(slot_mods) - len(valuables)])
+    return tuple(pools)
+
+
+def compressedFromState(state):
+    # Planner state as a simulator compressed state, with None for junk, so annulState/splitState (and their memo)
+    #   work on it directly. The base doesn't matter to the planner
+    prefix_valuables, prefix_junk, suffix_valuables, suffix_junk = state
+    return (0, prefix_valuables + (None,) * prefix_junk, suffix_valuables + (None,) * suffix_junk)
+
+
+def stateFromCompressedPools(compressed_state):
+    _, prefixes, suffixes = compressed_state
+    return stateFromMods([('Prefix', d) for d in prefixes] + [('Suffix', d) for d in suffixes])
+
+
+def annulStateOutcomes(state):
+    # Annulment removes one explicit mod uniformly at random, see simulator.annulState
+    outcomes = Counter()
+    for annulled, p in annulState(compressedFromState(state)).items():
+        outcomes[stateFromCompressedPools(annulled)] += p
+    return outcomes
+
+
+def splitStateOutcomes(state):
+    # See simulator.splitState for the assumptions
+    # Returns [(prob, (state a, state b))], the crafter then keeps whichever half is worth more
+    outcomes = Counter()
+    for (a, b), p in splitState(compressedFromState(state)).items():
+        outcomes[tuple(sorted([stateFromCompressedPools(a), stateFromCompressedPools(b)]))] += p
+    return list(outcomes.items())
+
+
+def recombStateOutcomes(state, donor_state):
+    # Same model as recombineItems: independent prefix/suffix pools with output sizes drawn from bafreq
+    bafreq = getBaFreq()
+    pool_outcomes = []
+    for valuables_index in [0, 2]:
+        valuables = state[valuables_index] + donor_state[valuables_index]
+        pool_size = len(valuables) + state[valuables_index + 1] + donor_state[valuables_index + 1]
+        if pool_size not in bafreq:
+            return None
+        output_sizes, masks, probs = getPoolOutcomeVectors(pool_size, range(len(valuables)), bafreq[pool_size])
+        pool_outcomes.append([
+            ((tuple(sorted(valuables[i] for i in mask.nonzero()[0])), int(N) - int(mask.sum())), float(prob))
+            for N, mask, prob in zip(output_sizes, masks, probs)
+        ])
+
+    outcomes = Counter()
+    for (prefix_pool, ppc), (suffix_pool, spc) in itertools.product(*pool_outcomes):
+        outcomes[prefix_pool + suffix_pool] += ppc * spc
+    return outcomes
+
+
+@dataclass
+class Donor:
+    # An item that can be bought repeatedly and recombined into the current one
+    # cost_c should include the recombinator itself
+    state: tuple
+    cost_c: float
+
+
+@dataclass
+class CraftingPlan:
+    expected_cost_c: float # inf when the target is unreachable, or when time ran out before any usable plan
+    action: tuple # ('timeout',) when time ran out before any usable plan
+    policy: dict = field(default_factory=dict) # (state, remaining depth) -> action
+    iterations: int = 0
+    timed_out: bool = False
+
+
+class PlannerTimeout(Exception):
+    pass
+
+
+def planCrafting(start_state, target_mods, donors=(), restart_cost_c=0, max_depth=4, time_budget_s=10, tol=1e-3, max_iterations=50):
+    # Cheapest expected cost to reach a state holding every description in target_mods (repeats allowed),
+    #   using annul/split/recomb with any donor, within max_depth actions per attempt
+    # A failed attempt can be abandoned for restart_cost_c, after which the whole plan is started over
+    # Sub-states shared between branches are solved once per iteration through the memo
+    # Running out of time_budget_s never raises: it returns the last plan that can reach the target with timed_out set
+    #   (its cost is priced with a restart value that hadn't converged yet), or if there is none yet, a plan with
+    #   timed_out set, expected_cost_c=inf, action ('timeout',) and an empty policy
+    target = Counter(target_mods)
+    deadline = time.perf_counter() + time_budget_s
+
+    def solve(restart_value):
+        # Values are (expected cost, probability of ending in a restart) so the restart value can be solved for below
+        memo = {}
+
+        def value(state, depth):
+            key = (state, depth)
+            if key in memo:
+                return memo[key][0]
+            if time.perf_counter() > deadline:
+                raise PlannerTimeout()
+
+            if stateSatisfies(state, target):
+                memo[key] = ((0, 0), ('done',))
+                return (0, 0)
+
+            # Starting over from the start state itself is never useful
+            candidates = []
+            if key != (start_state, max_depth):
+                candidates.append(((restart_value, 1), ('restart',)))
+
+            if depth > 0:
+                explicit_count = len(getStateMods(state))
+                if explicit_count > 0:
+                    outcomes = [(p, value(s, depth - 1)) for s, p in annulStateOutcomes(state).items()]
+                    candidates.append((expectValue(COST_ANNUL_C, outcomes), ('annul',)))
+
+                if explicit_count > 1:
+                    # The crafter keeps whichever half is cheaper to finish
+                    outcomes = [
+                        (p, min(value(a, depth - 1), value(b, depth - 1)))
+                        for (a, b), p in splitStateOutcomes(state)
+                    ]
+                    candidates.append((expectValue(COST_SPLIT_C, outcomes), ('split',)))
+
+                for donor_index, donor in enumerate(donors):
+                    outcomes = recombStateOutcomes(state, donor.state)
+                    if outcomes is None:
+                        continue
+                    outcomes = [(p, value(s, depth - 1)) for s, p in outcomes.items()]
+                    candidates.append((expectValue(donor.cost_c, outcomes), ('recomb', donor_index)))
+
+            if not candidates:
+                # Only possible for a start state with no applicable action
+                candidates.append(((float('inf'), 0), ('stuck',)))
+
+            best = min(candidates, key=lambda candidate: candidate[0][0])
+            memo[key] = best
+            return best[0]
+
+        root_value = value(start_state, max_depth)
+        policy = {key: action for key, (_, action) in memo.items()}
+        return root_value, memo[(start_state, max_depth)][1], policy
+
+    plan = None # Last plan that reaches the target with some chance, a restart-only policy never counts
+    restart_value = restart_cost_c
+    for iteration in range(1, max_iterations + 1):
+        try:
+            (expected_cost, restart_prob), action, policy = solve(restart_value)
+        except PlannerTimeout:
+            if plan is None:
+                return CraftingPlan(float('inf'), ('timeout',), {}, iteration - 1, timed_out=True)
+            plan.timed_out = True
+            return plan
+
+        if restart_prob >= 1 - 1e-12:
+            # Starting over is cheaper than any branch that can succeed, so the restart value is too low
+            # If it already is absurdly high, the target is unreachable within max_depth
+            if restart_value >= UNREACHABLE_COST_C:
+                return CraftingPlan(float('inf'), action, policy, iteration)
+            restart_value = restart_value * 10 + 1
+            continue
+
+        plan = CraftingPlan(expected_cost, action, policy, iteration)
+
+        # For the current policy, cost = a + restart_prob * restart_value, and a consistent restart value satisfies
+        #   restart_value = restart_cost_c + cost, so solve that directly (Newton step on the piecewise linear value)
+        fixed_cost = expected_cost - restart_prob * restart_value
+        new_restart_value = (restart_cost_c + fixed_cost) / (1 - restart_prob)
+        if abs(new_restart_value - restart_value) < tol:
+            break
+        restart_value = new_restart_value
+
+    if plan is None:
+        # max_iterations ran out while still raising the restart value
+        return CraftingPlan(float('inf'), action, policy, max_iterations)
+    return plan
+
+
+def expectValue(action_cost, outcomes):
+    # outcomes is [(probability, (expected cost, restart probability))]
+    return (
+        action_cost + sum(p * v[0] for p, v in outcomes),
+        sum(p * v[1] for p, v in outcomes),
+    )
@@ -1,5 +1,7 @@
 from dataclasses import dataclass, field
 
+from valuable import compileValuableMods
+
 
 @dataclass
 class PoEReq:
@@ -36,6 +38,11 @@ class PoEMod:
     doubled: list[list[int, int]] = field(default_factory=lambda: []) # Populated later after initial import - points at PoEEffect idx in parent.mods and other.mods
     kept: list[list[int, int]] = field(default_factory=lambda: []) # Same as doubled, but for self idx -> output idx
     requirements: list[str] = None # Used by planner to indicate what bases are required to keep said mod
+    description: str = field(default=None, init=False, repr=False, compare=False) # Cached stringDescription, filled on first call
+    # Filled by mod_identity.getModIdentity: RePoE mod id and group when they resolve, and the integer identity
+    repoe_mod_id: str = field(default=None, init=False, repr=False, compare=False)
+    mod_group: str = field(default=None, init=False, repr=False, compare=False)
+    identity: int = field(default=None, init=False, repr=False, compare=False)
 
     def getSlot(self):
         known_slots = ['Implicit', 'Prefix', 'Suffix']
@@ -44,11 +51,22 @@ class PoEMod:
                 return k
 
     def stringDescription(self):
-        return '\n'.join([e.description for e in self.effects])
+        # Effects are complete once parsing finishes, so the joined description only has to be built once
+        if self.description is None:
+            self.description = '\n'.join([e.description for e in self.effects])
+        return self.description
 
     def __hash__(self):
+        # Stays on the description (equality compares every field anyway), mods are compared by group
+        #   through mod_identity.getModIdentity where that matters
         return hash(self.stringDescription())
 
+    def __getstate__(self):
+        # Identities are interned per process, they are re-resolved after unpickling
+        state = self.__dict__.copy()
+        state['identity'] = None
+        return state
+
 
 # Unused
 @dataclass
@@ -78,9 +96,4 @@ class PoEItem:
     def getAffixes(self):
         return [m for m in self.mods if m.getSlot() in {'Prefix', 'Suffix'}]
     def getValuableCount(self, valuable_mods):
-        count = 0
-        for m in self.mods:
-            for vm in valuable_mods:
-                if m.stringDescription() == vm.description and m.tier <= vm.min_tier:
-                    count += 1
-        return count
\ No newline at end of file
+        return compileValuableMods(valuable_mods).getValuableCount(self.mods)
\ No newline at end of file
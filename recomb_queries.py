@@ -0,0 +1,170 @@
+import itertools
+import math
+from collections import Counter
+from functools import lru_cache
+
+from mod_identity import getModIdentity
+from simulator import getBaFreq, getLevel3Outcomes, getOutcomeGoodness, isJunkMod, recombineItems
+from valuable import compileValuableMods
+
+
+# Closed-form answers to narrow questions about a recomb, without building the state distribution
+# Within a pool every output size N is drawn from bafreq and then every N-combination of the pool is equally likely,
+#   so the number of surviving valuable mods is hypergeometric given N:
+#     P(v of k valuable survive | n, N) = C(k, v) * C(n - k, N - v) / C(n, N)
+#   and P(s given mods all survive | n, N) = C(n - s, N - s) / C(n, N)
+# Prefixes and suffixes are independent, and the base doesn't matter for any of these
+# Output sizes bigger than the pool have no combinations, so like the engines their bafreq mass drops out of the
+#   joint distribution, for both pools (single slot answers are scaled by the other pool's possible mass)
+# Everything here is cached on (pool size, count, bafreq row), so repeated queries are a few dict lookups
+
+SLOTS = ['Prefix', 'Suffix']
+
+
+def getPoolFreqKey(pool_size):
+    # Hashable bafreq row, part of every cache key so the caches stay correct if bafreq changes
+    return tuple(sorted(getBaFreq()[pool_size].items()))
+
+
+@lru_cache(maxsize=4096)
+def getSurvivorDistribution(pool_size, valuable_count, pool_freq):
+    # Tuple indexed by the number of the pool's valuable mods that survive
+    junk_count = pool_size - valuable_count
+    distribution = [0.0] * (valuable_count + 1)
+    for N, pc in pool_freq:
+        if pc == 0:
+            continue
+        total = math.comb(pool_size, N)
+        for v in range(max(0, N - junk_count), min(valuable_count, N) + 1):
+            distribution[v] += pc * math.comb(valuable_count, v) * math.comb(junk_count, N - v) / total
+    return tuple(distribution)
+
+
+@lru_cache(maxsize=4096)
+def getContainedChance(pool_size, required_count, pool_freq):
+    # Chance that required_count specific mods of the pool all survive
+    return sum(
+        pc * math.comb(pool_size - required_count, N - required_count) / math.comb(pool_size, N)
+        for N, pc in pool_freq
+        if required_count <= N <= pool_size
+    )
+
+
+def convolveDistributions(left, right):
+    distribution = [0.0] * (len(left) + len(right) - 1)
+    for i, pl in enumerate(left):
+        for j, pr in enumerate(right):
+            distribution[i + j] += pl * pr
+    return tuple(distribution)
+
+
+def getRecombPools(item1, item2):
+    return {
+        'Prefix': item1.getPrefixes() + item2.getPrefixes(),
+        'Suffix': item1.getSuffixes() + item2.getSuffixes(),
+    }
+
+
+def getValuableCountDistribution(item1, item2, valuable_mods, slot=None):
+    # Tuple indexed by the number of valuable mods on the output, for one slot ('Prefix'/'Suffix') or both
+    valuable_mods = compileValuableMods(valuable_mods)
+    distributions = {}
+    for pool_type, mod_pool in getRecombPools(item1, item2).items():
+        valuable_count = len(valuable_mods.getValuableIndices(mod_pool))
+        distributions[pool_type] = getSurvivorDistribution(len(mod_pool), valuable_count, getPoolFreqKey(len(mod_pool)))
+    if slot is None:
+        return convolveDistributions(distributions['Prefix'], distributions['Suffix'])
+    other_mass = sum(distributions[SLOTS[1 - SLOTS.index(slot)]])
+    return tuple(p * other_mass for p in distributions[slot])
+
+
+def getAtLeastChance(item1, item2, valuable_mods, min_valuables, slot=None):
+    # P(output keeps >= min_valuables valuable mods), for one slot or both
+    return sum(getValuableCountDistribution(item1, item2, valuable_mods, slot)[max(0, min_valuables):])
+
+
+def getSurviveChance(item1, item2, mods):
+    # P(every mod in mods ends up on the output), mods are PoEMods taken from item1/item2
+    # Matched by object so a doubled mod (same description on both inputs) counts once per copy
+    pools = getRecombPools(item1, item2)
+    chance = 1.0
+    remaining = list(mods)
+    for pool_type, mod_pool in pools.items():
+        required_count = sum(any(m is pm for pm in mod_pool) for m in remaining)
+        remaining = [m for m in remaining if not any(m is pm for pm in mod_pool)]
+        chance *= getContainedChance(len(mod_pool), required_count, getPoolFreqKey(len(mod_pool)))
+    if remaining:
+        raise ValueError(f'{remaining[0].stringDescription()} is not a mod of either input')
+    return chance
+
+
+def getAllValuableSurviveChance(item1, item2, valuable_mods, slot=None):
+    # P(every valuable mod of the slot, or of both slots, survives), eg "both valuable prefixes survive"
+    valuable_mods = compileValuableMods(valuable_mods)
+    mods = [
+        mod_pool[i]
+        for pool_type, mod_pool in getRecombPools(item1, item2).items()
+        if slot is None or pool_type == slot
+        for i in valuable_mods.getValuableIndices(mod_pool)
+    ]
+    return getSurviveChance(item1, item2, mods)
+
+
+def getLevel3Chances(item1, item2, valuable_mods):
+    # Same as getLevel3Outcomes(recombineItems(...), valuable_inputs), straight from the valuable count distribution
+    valuable_mods = compileValuableMods(valuable_mods)
+    max_valuable_input = max(item1.getValuableCount(valuable_mods), item2.getValuableCount(valuable_mods))
+    level3_outcomes = Counter()
+    for valuables, p in enumerate(getValuableCountDistribution(item1, item2, valuable_mods)):
+        if p == 0:
+            continue
+        if valuables == 0:
+            level3_outcomes['BRICK'] += p
+        else:
+            level3_outcomes[getOutcomeGoodness(valuables, max_valuable_input)] += p
+    return level3_outcomes
+
+
+def checkRecombQueries(item1, item2, valuable_mods, rel_tol=1e-9, max_subset_size=3):
+    # Compare every query against the enumerating engine, returns (agrees, list of (query, expected, actual))
+    valuable_mods = compileValuableMods(valuable_mods)
+    output_to_percent = recombineItems(item1, item2, valuable_mods, engine='python')
+
+    mismatched = []
+    def compare(query, expected, actual):
+        if not math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=1e-12):
+            mismatched.append((query, expected, actual))
+
+    for slot in [None] + SLOTS:
+        expected = Counter()
+        for state, percent in output_to_percent.items():
+            pools = state[1:] if slot is None else [state[1 + SLOTS.index(slot)]]
+            expected[sum(not isJunkMod(m) for pool in pools for m in pool)] += percent
+        actual = getValuableCountDistribution(item1, item2, valuable_mods, slot)
+        for valuables in set(expected) | set(range(len(actual))):
+            compare(('valuable_count', slot, valuables), expected[valuables], actual[valuables] if valuables < len(actual) else 0)
+
+    valuable_inputs = (item1.getValuableCount(valuable_mods), item2.getValuableCount(valuable_mods))
+    expected = getLevel3Outcomes(output_to_percent, valuable_inputs)
+    actual = getLevel3Chances(item1, item2, valuable_mods)
+    for goodness in set(expected) | set(actual):
+        compare(('level3', goodness), expected[goodness], actual[goodness])
+
+    # Only valuable mods keep their identity in the states, and mods sharing an identity (see
+    #   simulator.getValuableRepresentatives) all show up as the first of them, so containment is checked over
+    #   valuable mods whose identity is unique in their pool
+    pools = getRecombPools(item1, item2)
+    valuable_pool_mods = []
+    for mod_pool in pools.values():
+        valuable = [mod_pool[i] for i in valuable_mods.getValuableIndices(mod_pool)]
+        identity_counts = Counter(getModIdentity(m) for m in valuable)
+        valuable_pool_mods += [m for m in valuable if identity_counts[getModIdentity(m)] == 1]
+    for size in range(1, min(max_subset_size, len(valuable_pool_mods)) + 1):
+        for subset in itertools.combinations(valuable_pool_mods, size):
+            expected = sum(
+                percent for state, percent in output_to_percent.items()
+                if all(any(m is sm for pool in state[1:] for sm in pool) for m in subset)
+            )
+            compare(('survive', tuple(m.stringDescription() for m in subset)), expected, getSurviveChance(item1, item2, subset))
+
+    return (len(mismatched) == 0, mismatched)
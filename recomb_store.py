@@ -0,0 +1,236 @@
+import json
+import os
+import pickle
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from corpus_cache import PARALLEL_PARSE_THRESHOLD, getParseVersion
+from frequency_table import FrequencyTable
+from utils import annotateRecomb, getRecordPoolSizes, parseItem
+
+
+default_store_path = Path().parent / 'data/recombs.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS recombs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    raw_json TEXT NOT NULL,
+    parsed BLOB,
+    parse_version TEXT,
+    prefix_pool INTEGER,
+    suffix_pool INTEGER
+);
+CREATE TABLE IF NOT EXISTS items (
+    recomb_id INTEGER NOT NULL REFERENCES recombs(id),
+    item_type TEXT NOT NULL,
+    iclass TEXT,
+    base TEXT,
+    ilvl INTEGER,
+    prefix_count INTEGER,
+    suffix_count INTEGER,
+    PRIMARY KEY (recomb_id, item_type)
+);
+CREATE INDEX IF NOT EXISTS items_iclass ON items(iclass);
+CREATE INDEX IF NOT EXISTS items_base ON items(base);
+CREATE INDEX IF NOT EXISTS items_ilvl ON items(ilvl);
+CREATE INDEX IF NOT EXISTS recombs_pools ON recombs(prefix_pool, suffix_pool);
+'''
+
+
+def parseRawRecomb(raw_json, name):
+    # Same as utils.parseRecombFile + annotateRecomb, but from already loaded lines
+    # Returns None if any of the three items fails to parse
+    record = {}
+    for item_type in ['input1', 'input2', 'output']:
+        item = parseItem(raw_json[item_type], name)
+        if item is None:
+            return None
+        record[item_type] = item
+    annotateRecomb(record)
+    return record
+
+
+def parseRawRecombJson(raw_json, name):
+    # parseRawRecomb from the stored JSON text, the unit of work for parseRawRecombs
+    return parseRawRecomb(json.loads(raw_json), name)
+
+
+def parseRawRecombs(names, raw_jsons):
+    # [parsed record or None] in the same order, across a process pool above the same threshold as corpus_cache
+    if len(names) >= PARALLEL_PARSE_THRESHOLD and (os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor() as executor:
+            return list(executor.map(parseRawRecombJson, raw_jsons, names, chunksize=16))
+    return [parseRawRecombJson(raw_json, name) for raw_json, name in zip(raw_jsons, names)]
+
+
+class RecombStore:
+    # Single SQLite file holding every recorded recombination: raw clipboard lines, the pickled parsed record
+    #   (re-parsed from the raw lines whenever the parser version changes) and indexed columns for querying
+    def __init__(self, path=default_store_path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM recombs').fetchone()[0]
+
+    def getMeta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def setMeta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def writeParsed(self, recomb_id, record):
+        self.connection.execute('DELETE FROM items WHERE recomb_id = ?', (recomb_id,))
+        if record is None:
+            self.connection.execute('UPDATE recombs SET parsed = NULL, parse_version = ? WHERE id = ?', (getParseVersion(), recomb_id))
+            return
+
+        (prefix_pool, _), (suffix_pool, _) = getRecordPoolSizes(record)
+        self.connection.execute(
+            'UPDATE recombs SET parsed = ?, parse_version = ?, prefix_pool = ?, suffix_pool = ? WHERE id = ?',
+            (pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL), getParseVersion(), prefix_pool, suffix_pool, recomb_id),
+        )
+        self.connection.executemany(
+            'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (recomb_id, item_type, item.iclass, item.base, item.ilvl, len(item.getPrefixes()), len(item.getSuffixes()))
+                for item_type, item in record.items()
+            ],
+        )
+
+    def addRecomb(self, input1, input2, output, name=None, recomb_id=None):
+        # Append a recombination from raw clipboard lines, returns (name, parsed record or None)
+        # New records are named like the old data/json files ({id:05}.json) so recombs keys stay comparable
+        raw_json = json.dumps({'input1': input1, 'input2': input2, 'output': output})
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO recombs (id, name, raw_json) VALUES (?, ?, ?)',
+                (recomb_id, name or '', raw_json),
+            )
+            recomb_id = cursor.lastrowid
+            if name is None:
+                name = f'{str(recomb_id).zfill(5)}.json'
+                self.connection.execute('UPDATE recombs SET name = ? WHERE id = ?', (name, recomb_id))
+
+            record = parseRawRecomb(json.loads(raw_json), name)
+            self.writeParsed(recomb_id, record)
+        return name, record
+
+    def importJsonDirectory(self, json_dir):
+        # Import of data/json/NNNNN.json files, files already in the store are skipped so an interrupted import resumes
+        # Numeric file names keep their number as id, so later records continue the same numbering
+        existing = {row[0] for row in self.connection.execute('SELECT name FROM recombs')}
+        imported = []
+        for fname in sorted(os.listdir(json_dir)):
+            if fname in existing:
+                continue
+            with open(Path(json_dir) / fname, 'r') as f:
+                raw_json = json.load(f)
+            stem = fname.split('.')[0]
+            recomb_id = int(stem) if stem.isdigit() else None
+            self.addRecomb(raw_json['input1'], raw_json['input2'], raw_json['output'], name=fname, recomb_id=recomb_id)
+            imported.append(fname)
+        with self.connection:
+            self.setMeta('json_import_complete', '1')
+        return imported
+
+    def loadRecombs(self, iclass=None, base=None, min_ilvl=None, max_ilvl=None, prefix_pool=None, suffix_pool=None):
+        # Same output as utils.loadRecombsFromFileList, in id order, limited to records matching every given filter
+        # iclass/base/ilvl filters match if any of the three items matches, pool filters use the input pool sizes
+        conditions = []
+        params = []
+        item_conditions = []
+        for column, op, value in [('iclass', '=', iclass), ('base', '=', base), ('ilvl', '>=', min_ilvl), ('ilvl', '<=', max_ilvl)]:
+            if value is not None:
+                item_conditions.append(f'items.{column} {op} ?')
+                params.append(value)
+        if item_conditions:
+            conditions.append(f'id IN (SELECT recomb_id FROM items WHERE {" AND ".join(item_conditions)})')
+        for column, value in [('prefix_pool', prefix_pool), ('suffix_pool', suffix_pool)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+
+        query = 'SELECT id, name, raw_json, parsed, parse_version FROM recombs'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY id'
+
+        rows = self.connection.execute(query, params).fetchall()
+        current_parse_version = getParseVersion()
+        # Records parsed by an older parser are re-parsed from their raw lines (in parallel when there are many)
+        stale_rows = [row for row in rows if row[4] != current_parse_version]
+        stale = dict(zip(
+            [recomb_id for recomb_id, *_ in stale_rows],
+            parseRawRecombs([name for _, name, *_ in stale_rows], [raw_json for _, _, raw_json, *_ in stale_rows]),
+        ))
+
+        recombs = {}
+        for recomb_id, name, raw_json, parsed, parse_version in rows:
+            if parse_version != current_parse_version:
+                record = stale[recomb_id]
+            elif parsed is None:
+                record = None
+            else:
+                record = pickle.loads(parsed)
+
+            # Records that failed to parse keep their raw lines but are left out of the results
+            if record is not None:
+                recombs[name] = record
+
+        if stale:
+            with self.connection:
+                for recomb_id, record in stale.items():
+                    self.writeParsed(recomb_id, record)
+
+        return recombs
+
+    def loadFrequencyTable(self, recombs):
+        # FrequencyTable of recombs (every record, from loadRecombs), pickled in meta so a warm start doesn't rebuild it
+        # Records added since it was saved are added to it, a new parse version or a record it has that recombs
+        #   doesn't (eg one that no longer parses) rebuilds it
+        frequency_table = None
+        if self.getMeta('frequency_table_version') == getParseVersion():
+            try:
+                frequency_table = pickle.loads(self.getMeta('frequency_table'))
+            except (TypeError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                frequency_table = None
+
+        if frequency_table is None or frequency_table.records - set(recombs):
+            frequency_table = FrequencyTable.fromRecombs(recombs)
+            dirty = True
+        else:
+            dirty = False
+            for name, record in recombs.items():
+                dirty |= frequency_table.addRecord(name, record)
+
+        if dirty:
+            with self.connection:
+                self.setMeta('frequency_table', pickle.dumps(frequency_table, protocol=pickle.HIGHEST_PROTOCOL))
+                self.setMeta('frequency_table_version', getParseVersion())
+        return frequency_table
+
+    def getRawRecomb(self, name):
+        row = self.connection.execute('SELECT raw_json FROM recombs WHERE name = ?', (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+def openRecombStore(path=default_store_path, json_dir=Path().parent / 'data/json'):
+    # Open the store, importing the old one-file-per-record directory until an import has run to completion
+    # importJsonDirectory skips records that are already in, so an interrupted import picks up where it stopped
+    store = RecombStore(path)
+    if store.getMeta('json_import_complete') is None and os.path.isdir(json_dir):
+        store.importJsonDirectory(json_dir)
+    return store
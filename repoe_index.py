@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from termcolor import cprint
+
+from utils import convertModTextToGeneric
+
+
+# Compact index over RePoE's mods.json and base_items.json (https://github.com/brather1ng/RePoE)
+# The raw files are ~100MB of JSON, so they are compiled once into a SQLite file keyed by generic mod text
+#   (same form as PoEMod.stringDescription) and base name, and queried from there without loading the JSON
+#
+# python repoe_index.py --repoe-data ../RePoE/RePoE/data     build or rebuild data/repoe_index.sqlite
+
+default_repoe_data_path = Path('../RePoE/RePoE/data')
+default_index_path = Path().parent / 'data/repoe_index.sqlite'
+
+# Bump whenever the schema or the filtering rules change
+INDEX_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS mods (
+    id INTEGER PRIMARY KEY,
+    mod_id TEXT UNIQUE NOT NULL,
+    generic_text TEXT NOT NULL,
+    name TEXT,
+    mod_groups TEXT,
+    domain TEXT,
+    generation_type TEXT,
+    required_level INTEGER
+);
+CREATE TABLE IF NOT EXISTS spawn_weights (
+    mod_rowid INTEGER NOT NULL REFERENCES mods(id),
+    tag TEXT NOT NULL,
+    weight INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS base_items (
+    base_item_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    item_class TEXT,
+    tags TEXT
+);
+CREATE INDEX IF NOT EXISTS mods_generic_text ON mods(generic_text);
+CREATE INDEX IF NOT EXISTS spawn_weights_mod ON spawn_weights(mod_rowid);
+CREATE INDEX IF NOT EXISTS base_items_name ON base_items(name);
+'''
+
+
+@dataclass
+class RePoEMod:
+    mod_id: str
+    generic_text: str
+    name: str
+    groups: list[str]
+    domain: str
+    generation_type: str
+    required_level: int
+    spawn_weights: dict = field(default_factory=dict) # tag -> weight, in RePoE order
+
+
+def isIndexedMod(mod_id, info):
+    # Same filtering as RePoE.ipynb
+    if mod_id.startswith('WeaponTree'):
+        # Ignore Crucible mods
+        return False
+    if info.get('generation_type', 'N/A') in {'unique', 'scourge_benefit'}:
+        # Ignore various impossible sources or things out of league
+        return False
+    # Mods without text are mostly uniques or monster mods, which aren't useful
+    # Mods without spawn weights stay, a lot of useful mods like essence and beastcraft do not have any
+    return info.get('text') is not None
+
+
+def getSourceSignature(repoe_data_path):
+    # (name, size, mtime_ns) of the RePoE files, stored in the index so a changed checkout triggers a rebuild
+    signature = []
+    for name in ['mods.json', 'base_items.json']:
+        stat = os.stat(Path(repoe_data_path) / name)
+        signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def buildRePoEIndex(repoe_data_path=default_repoe_data_path, index_path=default_index_path):
+    # Compile mods.json and base_items.json into index_path, replacing any existing index
+    with open(Path(repoe_data_path) / 'mods.json', 'r') as f:
+        mods = json.load(f)
+    with open(Path(repoe_data_path) / 'base_items.json', 'r') as f:
+        base_items = json.load(f)
+
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    tmp_path = f'{index_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.executescript(SCHEMA)
+    with connection:
+        mod_count = 0
+        for mod_id, info in mods.items():
+            if not isIndexedMod(mod_id, info):
+                continue
+            # Older RePoE versions have a single "group", newer ones a "groups" list
+            groups = info.get('groups', [info['group']] if info.get('group') else [])
+            cursor = connection.execute(
+                'INSERT INTO mods (mod_id, generic_text, name, mod_groups, domain, generation_type, required_level) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    mod_id,
+                    convertModTextToGeneric(info['text']),
+                    info.get('name', ''),
+                    json.dumps(groups),
+                    info.get('domain'),
+                    info.get('generation_type'),
+                    info.get('required_level'),
+                ),
+            )
+            connection.executemany(
+                'INSERT INTO spawn_weights VALUES (?, ?, ?)',
+                [(cursor.lastrowid, w['tag'], w['weight']) for w in info.get('spawn_weights', [])],
+            )
+            mod_count += 1
+
+        connection.executemany(
+            'INSERT INTO base_items VALUES (?, ?, ?, ?)',
+            [
+                (base_item_id, info['name'], info.get('item_class'), json.dumps(info.get('tags', [])))
+                for base_item_id, info in base_items.items()
+            ],
+        )
+        connection.executemany(
+            'INSERT INTO meta VALUES (?, ?)',
+            [
+                ('version', str(INDEX_VERSION)),
+                ('source_signature', json.dumps(getSourceSignature(repoe_data_path))),
+            ],
+        )
+    connection.close()
+    os.replace(tmp_path, index_path)
+    return mod_count, len(base_items)
+
+
+class RePoEIndex:
+    # Read-only queries against a built index, per text/base lookups are memoized since the same few hundred
+    #   descriptions and bases are asked for over and over
+    def __init__(self, index_path=default_index_path):
+        self.path = index_path
+        self.connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+        self.mod_ids_for_text = {}
+        self.mods = {}
+        self.base_item_ids = {}
+
+    def close(self):
+        self.connection.close()
+
+    def getMeta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def getModIdsForText(self, generic_text):
+        # RePoE mod ids whose text converts to generic_text, eg 'Adds X to X Physical Damage'
+        if generic_text not in self.mod_ids_for_text:
+            rows = self.connection.execute('SELECT mod_id FROM mods WHERE generic_text = ? ORDER BY id', (generic_text,))
+            self.mod_ids_for_text[generic_text] = [row[0] for row in rows]
+        return self.mod_ids_for_text[generic_text]
+
+    def getMod(self, mod_id):
+        if mod_id not in self.mods:
+            row = self.connection.execute(
+                'SELECT id, mod_id, generic_text, name, mod_groups, domain, generation_type, required_level FROM mods WHERE mod_id = ?',
+                (mod_id,),
+            ).fetchone()
+            if row is None:
+                self.mods[mod_id] = None
+            else:
+                rowid, *fields = row
+                fields[3] = json.loads(fields[3])
+                spawn_weights = self.connection.execute('SELECT tag, weight FROM spawn_weights WHERE mod_rowid = ? ORDER BY rowid', (rowid,))
+                self.mods[mod_id] = RePoEMod(*fields, spawn_weights=dict(spawn_weights.fetchall()))
+        return self.mods[mod_id]
+
+    def getModsForText(self, generic_text):
+        return [self.getMod(mod_id) for mod_id in self.getModIdsForText(generic_text)]
+
+    def getModGroups(self, mod_id):
+        mod = self.getMod(mod_id)
+        return [] if mod is None else mod.groups
+
+    def getSpawnWeights(self, mod_id):
+        mod = self.getMod(mod_id)
+        return {} if mod is None else mod.spawn_weights
+
+    def getBaseItemIds(self, base_name):
+        # Metadata ids for a base name, eg 'Reaver Axe' -> ['Metadata/Items/Weapons/OneHandWeapons/OneHandAxes/OneHandAxe18']
+        if base_name not in self.base_item_ids:
+            rows = self.connection.execute('SELECT base_item_id FROM base_items WHERE name = ? ORDER BY base_item_id', (base_name,))
+            self.base_item_ids[base_name] = [row[0] for row in rows]
+        return self.base_item_ids[base_name]
+
+    def getBaseItem(self, base_item_id):
+        # (name, item class, tags) or None
+        row = self.connection.execute('SELECT name, item_class, tags FROM base_items WHERE base_item_id = ?', (base_item_id,)).fetchone()
+        if row is None:
+            return None
+        name, item_class, tags = row
+        return name, item_class, json.loads(tags)
+
+    def getItemClass(self, base_name):
+        # Item class for a base name, None if the name is unknown or ambiguous
+        item_classes = {self.getBaseItem(base_item_id)[1] for base_item_id in self.getBaseItemIds(base_name)}
+        return item_classes.pop() if len(item_classes) == 1 else None
+
+    def getBaseTags(self, base_name):
+        # Union of the tags of every base item with this name, used to match spawn weights
+        tags = set()
+        for base_item_id in self.getBaseItemIds(base_name):
+            tags.update(self.getBaseItem(base_item_id)[2])
+        return tags
+
+
+def isIndexStale(index_path, repoe_data_path):
+    if not os.path.exists(index_path):
+        return True
+    if not os.path.isdir(repoe_data_path):
+        # Nothing to rebuild from, keep using whatever was built before
+        return False
+    index = RePoEIndex(index_path)
+    try:
+        return (
+            index.getMeta('version') != str(INDEX_VERSION)
+            or json.loads(index.getMeta('source_signature') or 'null') != getSourceSignature(repoe_data_path)
+        )
+    except sqlite3.DatabaseError:
+        return True
+    finally:
+        index.close()
+
+
+def openRePoEIndex(index_path=default_index_path, repoe_data_path=default_repoe_data_path):
+    # Open the index, building it first if it is missing or older than the RePoE checkout
+    # Returns None if there is no index and no RePoE data to build one from
+    if isIndexStale(index_path, repoe_data_path):
+        if not os.path.isdir(repoe_data_path):
+            return None
+        buildRePoEIndex(repoe_data_path, index_path)
+    return RePoEIndex(index_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile RePoE mods.json and base_items.json into a compact index')
+    parser.add_argument('--repoe-data', type=Path, default=default_repoe_data_path, help='RePoE/RePoE/data directory')
+    parser.add_argument('--output', type=Path, default=default_index_path)
+    args = parser.parse_args()
+
+    mod_count, base_count = buildRePoEIndex(args.repoe_data, args.output)
+    cprint(f'Indexed {mod_count} mods and {base_count} base items into {args.output}', 'green')
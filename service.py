@@ -0,0 +1,431 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+
+from termcolor import cprint
+
+from poe_types import PoEEffect, PoEItem, PoEMod, PoEReq, PoESocket
+from recomb_store import parseRawRecomb
+from simulator import (
+    RecombOutcomeSummary,
+    addRecordedRecomb,
+    fillRecombOutcomeCache,
+    getCorpus,
+    getRecombSignature,
+    recomb_outcome_cache,
+    recombineItems,
+    summarizeRecombOutcomes,
+)
+from utils import parseItem
+from valuable import ValuableMod, ValuablePattern, compileValuableMods
+
+
+# Resident simulation service: keeps the corpus, bafreq and outcome caches warm across notebooks and the recording REPL
+# Protocol is one JSON object per line in each direction over a Unix socket (or localhost TCP where there are none):
+#   -> {"id": 1, "method": "recombine", "params": {...}}
+#   <- {"id": 1, "result": {...}} or {"id": 1, "error": "..."}
+#
+# python service.py                  serve on data/simulator.sock
+# python service.py --port 8765      serve on localhost:8765
+#
+# Clients use SimulatorClient, recombineItemsRemote and rankRecombPairsRemote below
+
+default_socket_path = Path().parent / 'data/simulator.sock'
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+# JSON forms of items and valuable mods
+# Items are either raw clipboard lines (parsed by the service) or dataclasses.asdict(PoEItem)
+def itemToJson(item):
+    if isinstance(item, PoEItem):
+        data = asdict(item)
+        for m in data['mods']:
+            for name in ['description', 'repoe_mod_id', 'mod_group', 'identity']:
+                m.pop(name, None)
+        return data
+    return list(item)
+
+
+def itemFromJson(data):
+    if isinstance(data, list):
+        item = parseItem(data, 'service')
+        if item is None:
+            raise ServiceError('Unable to parse item')
+        return item
+    mods = [
+        PoEMod(
+            m['category'],
+            m['title'],
+            m['tier'],
+            m['tags'],
+            [PoEEffect(**e) for e in m['effects']],
+            m.get('doubled', []),
+            m.get('kept', []),
+            m.get('requirements'),
+        )
+        for m in data['mods']
+    ]
+    return PoEItem(
+        data['iclass'],
+        data['rarity'],
+        data['name'],
+        data['base'],
+        data['traits'],
+        PoEReq(**data['req']),
+        PoESocket(**data['sockets']),
+        data['ilvl'],
+        mods,
+        data.get('special_types'),
+    )
+
+
+def valuableModsToJson(valuable_mods):
+    return [asdict(vm) for vm in valuable_mods]
+
+
+def valuableModsFromJson(data):
+    return compileValuableMods([ValuablePattern(**vm) if 'pattern' in vm else ValuableMod(**vm) for vm in data])
+
+
+def summaryToJson(summary):
+    return {
+        'valuable_inputs': list(summary.valuable_inputs),
+        'user_outcomes': [[list(ps_short), list(prefixes), list(suffixes), p] for (ps_short, prefixes, suffixes), p in summary.user_outcomes.items()],
+        'level2_outcomes': [[goodness, list(prefixes), list(suffixes), p] for (goodness, prefixes, suffixes), p in summary.level2_outcomes.items()],
+        'level3_outcomes': dict(summary.level3_outcomes),
+        'level3_prefix_suffix': {
+            goodness: [[list(ps_short), p] for ps_short, p in ps_outcomes.items()]
+            for goodness, ps_outcomes in summary.level3_prefix_suffix.items()
+        },
+    }
+
+
+def summaryFromJson(data):
+    # Everything but level 0 (the states themselves), so renderRecombOutcomes works on it for levels 1-3
+    level3_prefix_suffix = defaultdict(Counter)
+    for goodness, ps_outcomes in data['level3_prefix_suffix'].items():
+        for ps_short, p in ps_outcomes:
+            level3_prefix_suffix[goodness][tuple(ps_short)] = p
+    return RecombOutcomeSummary(
+        tuple(data['valuable_inputs']),
+        Counter(),
+        Counter({(tuple(ps_short), tuple(prefixes), tuple(suffixes)): p for ps_short, prefixes, suffixes, p in data['user_outcomes']}),
+        Counter({(goodness, tuple(prefixes), tuple(suffixes)): p for goodness, prefixes, suffixes, p in data['level2_outcomes']}),
+        Counter(data['level3_outcomes']),
+        level3_prefix_suffix,
+    )
+
+
+def statesToJson(output_to_percent):
+    # [item base index, prefix descriptions, suffix descriptions, chance], junk mods keep their 'Junk Prefix'/'Junk Suffix' text
+    return [
+        [item_base_index, [m.stringDescription() for m in prefixes], [m.stringDescription() for m in suffixes], p]
+        for (item_base_index, prefixes, suffixes), p in output_to_percent.items()
+    ]
+
+
+def rankPairsInWorker(items, valuable_mods, top_k=20, engine='compact', max_workers=1):
+    # rank_pairs, run in the service's ranking process so a long ranking never holds up the engine thread
+    from pair_ranking import rankRecombPairs
+    top, skipped = rankRecombPairs(
+        [itemFromJson(item) for item in items],
+        valuableModsFromJson(valuable_mods),
+        top_k=top_k,
+        engine=engine,
+        max_workers=max_workers,
+    )
+    return {'top': [asdict(score) for score in top], 'skipped': [list(s) for s in skipped]}
+
+
+class SimulationService:
+    # All engine work runs on one thread, which keeps the (not thread safe) outcome caches consistent and lets
+    #   requests that arrive together be evaluated as one batch:
+    #   - identical requests are evaluated once
+    #   - the canonical distributions of every cached engine recombine request are filled in before any of them runs,
+    #     with one getPoolOutcomeVectors call per distinct pool signature in the batch, then each request only
+    #     fills in its own mods
+    # rank_pairs scores up to n^2 pairs, so it runs in separate ranking processes instead, a slow ranking only ever
+    #   waits on other rankings and every other request keeps the engine thread to itself
+    def __init__(self, engine='cached', batch_window_s=0.002, max_batch=256, rank_workers=1):
+        self.engine = engine
+        self.batch_window_s = batch_window_s
+        self.max_batch = max_batch
+        self.rank_workers = rank_workers
+        self.rank_executor = None
+        self.rank_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.stats = Counter()
+        self.methods = {
+            'ping': self.ping,
+            'stats': self.getStats,
+            'recombine': self.recombine,
+            'add_recomb': self.addRecomb,
+        }
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        getCorpus()
+        self.thread.start()
+
+    def submit(self, method, params):
+        if method == 'rank_pairs':
+            with self.rank_lock:
+                self.stats['rank_pairs'] += 1
+                if self.rank_executor is None:
+                    # Spawned rather than forked, forking a process with running threads can copy held locks
+                    self.rank_executor = ProcessPoolExecutor(
+                        max_workers=self.rank_workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=getCorpus,
+                    )
+                return self.rank_executor.submit(rankPairsInWorker, **params)
+        future = Future()
+        self.requests.put((method, params, future))
+        return future
+
+    def resetRankExecutor(self):
+        # Ranking processes load the corpus once when they start, so new records need new ones
+        # Rankings already running finish on the old processes
+        with self.rank_lock:
+            if self.rank_executor is not None:
+                self.rank_executor.shutdown(wait=False)
+                self.rank_executor = None
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.batch_window_s
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.processBatch(batch)
+
+    def processBatch(self, batch):
+        self.stats['batches'] += 1
+        self.stats['requests'] += len(batch)
+
+        grouped = defaultdict(list)
+        for method, params, future in batch:
+            grouped[(method, json.dumps(params, sort_keys=True))].append((method, params, future))
+        self.stats['deduplicated'] += len(batch) - len(grouped)
+
+        # Recombine requests first, ordered by signature so requests sharing a distribution run back to back
+        prepared = []
+        for requests in grouped.values():
+            method, params, _ = requests[0]
+            try:
+                if method not in self.methods:
+                    raise ServiceError(f'Unknown method "{method}"')
+                args = self.prepareRecombine(params) if method == 'recombine' else None
+                prepared.append((args[-1] if args else (), method, params, args, requests))
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+        prepared.sort(key=lambda x: (x[1] != 'recombine', repr(x[0])))
+
+        cached_signatures = [args[-1] for _, method, _, args, _ in prepared if method == 'recombine' and args[3] == 'cached']
+        if cached_signatures:
+            self.stats['pool_signatures'] += fillRecombOutcomeCache(cached_signatures)
+
+        for _, method, params, args, requests in prepared:
+            try:
+                result = self.recombine(*args[:-1]) if method == 'recombine' else self.methods[method](**params)
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+                continue
+            for _, _, future in requests:
+                future.set_result(result)
+
+    def prepareRecombine(self, params):
+        item1 = itemFromJson(params['item1'])
+        item2 = itemFromJson(params['item2'])
+        valuable_mods = valuableModsFromJson(params['valuable_mods'])
+        engine = params.get('engine', self.engine)
+        return (item1, item2, valuable_mods, engine, getRecombSignature(item1, item2, valuable_mods))
+
+    def ping(self):
+        return {'pid': os.getpid(), 'recombs': len(getCorpus().recombs)}
+
+    def getStats(self):
+        return {'service': dict(self.stats), 'outcome_cache': recomb_outcome_cache.info()}
+
+    def recombine(self, item1, item2, valuable_mods, engine):
+        output_to_percent = recombineItems(item1, item2, valuable_mods, engine=engine)
+        summary = summarizeRecombOutcomes(
+            output_to_percent,
+            (item1.getValuableCount(valuable_mods), item2.getValuableCount(valuable_mods)),
+        )
+        return {'states': statesToJson(output_to_percent), 'summary': summaryToJson(summary)}
+
+    def addRecomb(self, name, input1, input2, output):
+        # Keep the service corpus in step with a recording client, the client still writes the record itself
+        record = parseRawRecomb({'input1': input1, 'input2': input2, 'output': output}, name)
+        if record is not None:
+            addRecordedRecomb(name, record)
+            self.resetRankExecutor()
+        return {'added': record is not None}
+
+
+class ServiceRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                result = service.submit(request['method'], request.get('params', {})).result()
+                response = {'id': request_id, 'result': result}
+            except Exception as e:
+                response = {'id': request_id, 'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+
+# The default listen backlog of 5 refuses connections (EAGAIN on Unix sockets) when many clients connect at once
+REQUEST_QUEUE_SIZE = 128
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+    allow_reuse_address = True
+
+
+def serve(address=default_socket_path, engine='cached'):
+    # address is a socket path or a (host, port) tuple
+    service = SimulationService(engine=engine)
+    service.start()
+    if isinstance(address, tuple):
+        server = ThreadingTCPServer(address, ServiceRequestHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        os.makedirs(os.path.dirname(address) or '.', exist_ok=True)
+        server = ThreadingUnixServer(str(address), ServiceRequestHandler)
+    server.service = service
+    cprint(f'Serving {len(getCorpus().recombs)} recombs on {address}', 'green')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
+
+
+class SimulatorClient:
+    # Thin client, one persistent connection, calls are serialized per client (use one client per thread)
+    def __init__(self, address=default_socket_path, timeout=60):
+        self.address = address
+        self.timeout = timeout
+        self.connection = None
+        self.next_id = 0
+
+    def connect(self):
+        if isinstance(self.address, tuple):
+            self.connection = socket.create_connection(self.address, timeout=self.timeout)
+        else:
+            # Connect in blocking mode, a timeout makes a Unix socket connect non-blocking, so a full backlog raises
+            #   EAGAIN straight away instead of waiting
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.connect(str(self.address))
+            self.connection.settimeout(self.timeout)
+        self.reader = self.connection.makefile('rb')
+
+    def close(self):
+        if self.connection is not None:
+            self.reader.close()
+            self.connection.close()
+            self.connection = None
+
+    def call(self, method, **params):
+        if self.connection is None:
+            self.connect()
+        self.next_id += 1
+        request = {'id': self.next_id, 'method': method, 'params': params}
+        self.connection.sendall((json.dumps(request) + '\n').encode())
+        line = self.reader.readline()
+        if not line:
+            self.close()
+            raise ServiceError('Service closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ServiceError(response['error'])
+        return response['result']
+
+
+def isServiceRunning(address=default_socket_path):
+    try:
+        client = SimulatorClient(address, timeout=1)
+        client.call('ping')
+        client.close()
+        return True
+    except (OSError, ServiceError):
+        return False
+
+
+def recombineItemsRemote(item1, item2, valuable_mods, engine='cached', client=None):
+    # Items are PoEItems or raw clipboard lines, returns (states, RecombOutcomeSummary without level 0)
+    # See statesToJson for the state format
+    client = client or SimulatorClient()
+    result = client.call(
+        'recombine',
+        item1=itemToJson(item1),
+        item2=itemToJson(item2),
+        valuable_mods=valuableModsToJson(valuable_mods),
+        engine=engine,
+    )
+    return result['states'], summaryFromJson(result['summary'])
+
+
+def rankRecombPairsRemote(items, valuable_mods, top_k=20, engine='compact', client=None):
+    # Same as pair_ranking.rankRecombPairs, PairScores come back as dicts
+    client = client or SimulatorClient()
+    result = client.call(
+        'rank_pairs',
+        items=[itemToJson(item) for item in items],
+        valuable_mods=valuableModsToJson(valuable_mods),
+        top_k=top_k,
+        engine=engine,
+    )
+    return result['top'], result['skipped']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the simulator over a local socket')
+    parser.add_argument('--socket', type=Path, default=default_socket_path)
+    parser.add_argument('--port', type=int, default=None, help='Serve on localhost TCP instead of a Unix socket')
+    parser.add_argument('--engine', default='cached')
+    args = parser.parse_args()
+
+    # Exit through serve's cleanup (removing the socket file) on kill as well as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve(('127.0.0.1', args.port) if args.port else args.socket, engine=args.engine)
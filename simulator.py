@@ -1,42 +1,85 @@
 import itertools
+import math
 import os
 import random
-from collections import Counter, defaultdict
+import threading
+from collections import Counter, OrderedDict, defaultdict
 from copy import deepcopy
-from dataclasses import asdict
+from dataclasses import dataclass
 from pathlib import Path
 
-from termcolor import colored, cprint
+import numpy as np
+from termcolor import cprint
 
+from corpus_cache import loadRecombsCached
+from frequency_table import FrequencyTable
+from instrumentation import instrumentation
+from mod_identity import getModIdentity
+from mod_intern import JUNK_PREFIX_ID, JUNK_SUFFIX_ID, SLOT_CODES, CompactMod, compactMods, expandCompactMod, mod_intern_table
 from poe_types import *
-from utils import loadRecombsFromFileList
+from recomb_store import default_store_path, openRecombStore
+from utils import annotateRecomb, parseRecombFile
+from valuable import compileValuableMods
+from valuable import ValuableMod, ValuableModSet, ValuablePattern # re-exported, part of the simulator API from before valuable.py
 
 
-# Load historical recombs for easier item bases and recomb data
+# Historical recombs for easier item bases and recomb data
+# Loaded on first use through getCorpus() rather than at import, so importing simulator stays cheap
 json_dir = Path().parent / 'data/json'
-recombination_files = sorted(os.listdir(json_dir))
-recombination_files_full = [json_dir / name for name in recombination_files]
-recombs = loadRecombsFromFileList(recombination_files_full)
-
-# Calculate pool size before_after
-before_after = defaultdict(list)
-for fpath in recombination_files:
-    data = recombs[fpath]
-    countSlots = lambda item, slot: sum([m.getSlot() == slot for m in item.mods])
-    input_prefix_count = countSlots(data['input1'], 'Prefix') + countSlots(data['input2'], 'Prefix')
-    input_suffix_count = countSlots(data['input1'], 'Suffix') + countSlots(data['input2'], 'Suffix')
-    output_prefix_count = countSlots(data['output'], 'Prefix')
-    output_suffix_count = countSlots(data['output'], 'Suffix')
-    
-    before_after[input_prefix_count].append(output_prefix_count)
-    before_after[input_suffix_count].append(output_suffix_count)
 
-# Put it in a frequency version to make it simpler
-bafreq = {}
-for in_pool in sorted(list(before_after.keys())): 
-    freq = Counter(before_after[in_pool])
-    total = freq.total()
-    bafreq[in_pool] = {outcome: round(num/total,  3) for outcome, num in freq.items()}
+
+@dataclass
+class Corpus:
+    recombs: dict
+    frequency_table: FrequencyTable
+
+
+corpus = None
+corpus_lock = threading.Lock()
+
+
+def loadCorpus():
+    # Prefer the indexed store once it exists (see recomb_store), otherwise the old one-file-per-record directory
+    # The store keeps parsed records and the frequency table, so a warm start unpickles both instead of parsing
+    if os.path.exists(default_store_path):
+        store = openRecombStore(default_store_path)
+        recombs = store.loadRecombs()
+        frequency_table = store.loadFrequencyTable(recombs)
+        store.close()
+    else:
+        recombination_files = sorted(os.listdir(json_dir))
+        recombination_files_full = [json_dir / name for name in recombination_files]
+        recombs, frequency_table = loadRecombsCached(recombination_files_full)
+    return Corpus(recombs, frequency_table)
+
+
+def getCorpus():
+    # Locked so a background preview and the main thread can't both load the corpus
+    global corpus
+    if corpus is None:
+        with corpus_lock:
+            if corpus is None:
+                corpus = loadCorpus()
+    return corpus
+
+
+def getBaFreq():
+    # Input pool size -> {output pool size: chance}, updated in place by the frequency table, see addRecordedRecomb
+    return getCorpus().frequency_table.bafreq
+
+
+def __getattr__(name):
+    # The corpus used to be module level, keep simulator.recombs, simulator.bafreq etc. working (this loads it)
+    if name == 'recombs':
+        return getCorpus().recombs
+    if name == 'frequency_table':
+        return getCorpus().frequency_table
+    if name == 'bafreq':
+        return getBaFreq()
+    if name == 'before_after':
+        return getCorpus().frequency_table.getBeforeAfter()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 # Recomb crafting methods
 junk_prefix_dict = {
@@ -58,6 +101,26 @@ junk_suffix_dict['category'] = 'Suffix'
 junk_suffix_dict['effects'][0].description = 'Junk Suffix'
 
 
+def addRecordedRecomb(name, record):
+    # Add a newly recorded, parsed and annotated recomb to the running simulator
+    # bafreq rows are refreshed in place, so recombineItems and the outcome caches pick it up immediately
+    # Nothing to do if the corpus isn't loaded yet, it reads the record from disk when it is
+    with corpus_lock:
+        if corpus is None:
+            return
+        corpus.recombs[name] = record
+        corpus.frequency_table.addRecord(name, record)
+
+
+def recordRecomb(full_fpath):
+    # Same as addRecordedRecomb for a newly written data/json file
+    # The on-disk cache catches up on the next loadRecombsCached, which only parses this one file
+    record = parseRecombFile(full_fpath)
+    annotateRecomb(record)
+    addRecordedRecomb(full_fpath.name, record)
+    return record
+
+
 def check_recombineItems(item1, item2, valuable_mods):
     if len(valuable_mods) == 0:
         return (False, 'No valuable mods so no point recombining')    
@@ -67,7 +130,17 @@ def check_recombineItems(item1, item2, valuable_mods):
     return (True, '')
 
 
-def recombineItems(item1, item2, valuable_mods):
+def recombineItems(item1, item2, valuable_mods, engine='python'):
+    valuable_mods = compileValuableMods(valuable_mods)
+    if engine == 'numpy':
+        with instrumentation.timer('recombine.numpy'):
+            return recombineItemsVectorized(item1, item2, valuable_mods)
+    elif engine == 'cached':
+        with instrumentation.timer('recombine.cached'):
+            return recombineItemsCached(item1, item2, valuable_mods)
+    elif engine != 'python':
+        raise ValueError(f'Unknown recombination engine "{engine}"')
+
     input_pools = {
         'Prefix': item1.getPrefixes() + item2.getPrefixes(),
         'Suffix': item1.getSuffixes() + item2.getSuffixes(),
@@ -78,31 +151,36 @@ def recombineItems(item1, item2, valuable_mods):
     # TODO: Average ilvl
     
     # Generate outcomes for individual pools
+    bafreq = getBaFreq()
     pool_output_mod_chances = defaultdict(list)
-    for pool_type, mod_pool in input_pools.items():
-        for outcome, pc in bafreq[len(mod_pool)].items():
-            N = outcome
-            possible_mod_combos = list(itertools.combinations(range(len(mod_pool)), N))
-            pool_output_mod_chances[pool_type].extend(
-                [(pc / len(possible_mod_combos), x) for x in possible_mod_combos]
-            )
+    with instrumentation.timer('recombine.enumerate'):
+        for pool_type, mod_pool in input_pools.items():
+            for outcome, pc in bafreq[len(mod_pool)].items():
+                N = outcome
+                possible_mod_combos = list(itertools.combinations(range(len(mod_pool)), N))
+                pool_output_mod_chances[pool_type].extend(
+                    [(pc / len(possible_mod_combos), x) for x in possible_mod_combos]
+                )
     # display(pool_output_mod_chances)
     
     # Combine modpools into final output item
     final_output_mod_chances = []
-    for prefix_outcome in pool_output_mod_chances['Prefix']:
-        for suffix_outcome in pool_output_mod_chances['Suffix']:
-            ppc, prefix_pool = prefix_outcome
-            spc, suffix_pool = suffix_outcome
-            final_output_mod_chances.append((ppc * spc, (prefix_pool, suffix_pool)))
+    with instrumentation.timer('recombine.product'):
+        for prefix_outcome in pool_output_mod_chances['Prefix']:
+            for suffix_outcome in pool_output_mod_chances['Suffix']:
+                ppc, prefix_pool = prefix_outcome
+                spc, suffix_pool = suffix_outcome
+                final_output_mod_chances.append((ppc * spc, (prefix_pool, suffix_pool)))
 
     # display(final_output_mod_chances)
 
     # Pick each base for every output chance (so doubling the number of output states)
     item_output_chances = []
-    for pc, mod_outcome in final_output_mod_chances:
-        for i in range(0, 2):
-            item_output_chances.append((i, pc/2, mod_outcome))
+    with instrumentation.timer('recombine.doubling'):
+        for pc, mod_outcome in final_output_mod_chances:
+            for i in range(0, 2):
+                item_output_chances.append((i, pc/2, mod_outcome))
+    instrumentation.count('recombine.states_generated', len(item_output_chances))
 
     # display(item_output_chances[:10])
     # print(len(item_output_chances))
@@ -111,125 +189,625 @@ def recombineItems(item1, item2, valuable_mods):
     # If "valuable" modifiers drop below a certain tier, they are considered junk now
     # TODO: This may not work after doubling is implemented (if doubling doesn't naturally happen)
 
-    # Get valuable indices for each pool
-    valuable_indices = defaultdict(set)
-    for pool_type, mod_pool in input_pools.items():
-        for i, m in enumerate(mod_pool):
-            for vm in valuable_mods:
-                if m.stringDescription() == vm.description and m.tier <= vm.min_tier:
-                    valuable_indices[pool_type].add(i)
+    with instrumentation.timer('recombine.compress'):
+        # Get valuable indices for each pool, and the mod each one shows up as in the states
+        representatives = {
+            pool_type: getValuableRepresentatives(mod_pool, valuable_mods.getValuableIndices(mod_pool))
+            for pool_type, mod_pool in input_pools.items()
+        }
 
-    # Convert states to final mod + placeholder junk mods - hopefully this reduces the number of states to consider
-    output_to_percent = Counter()
-    for item_base_index, output_prob, mod_pair_indices in item_output_chances:
-        output_prefix_pool, output_suffix_pool = mod_pair_indices
-
-        compressed_prefix_pool = tuple(
-            sorted((
-                (input_pools['Prefix'][m] if m in valuable_indices['Prefix'] else PoEMod(**junk_prefix_dict))
-                for m in output_prefix_pool
-            ), key=lambda mod: mod.stringDescription())
-        )
-        compressed_suffix_pool = tuple(
-            sorted((
-                (input_pools['Suffix'][m] if m in valuable_indices['Suffix'] else PoEMod(**junk_suffix_dict))
-                for m in output_suffix_pool
-            ), key=lambda mod: mod.stringDescription())
-        )
+        # Convert states to final mod + placeholder junk mods - hopefully this reduces the number of states to consider
+        # Each index combination shows up once per pairing with the other pool and per base, so compress it once
+        #   (this also lets every state with that pool share one tuple, see summarizeRecombOutcomes)
+        compressed_pools = {}
+        def compressPool(pool_type, output_pool, junk_dict):
+            key = (pool_type, output_pool)
+            if key not in compressed_pools:
+                compressed_pools[key] = tuple(
+                    sorted((
+                        (representatives[pool_type][m] if m in representatives[pool_type] else PoEMod(**junk_dict))
+                        for m in output_pool
+                    ), key=getStateSortKey)
+                )
+            return compressed_pools[key]
+
+        output_to_percent = Counter()
+        for item_base_index, output_prob, mod_pair_indices in item_output_chances:
+            output_prefix_pool, output_suffix_pool = mod_pair_indices
+
+            compressed_prefix_pool = compressPool('Prefix', output_prefix_pool, junk_prefix_dict)
+            compressed_suffix_pool = compressPool('Suffix', output_suffix_pool, junk_suffix_dict)
         
-        compressed_state = (
-            item_base_index,
-            compressed_prefix_pool,
-            compressed_suffix_pool,
-        )
-        output_to_percent[compressed_state] += output_prob
+            compressed_state = (
+                item_base_index,
+                compressed_prefix_pool,
+                compressed_suffix_pool,
+            )
+            output_to_percent[compressed_state] += output_prob
+    instrumentation.count('recombine.states_compressed', len(output_to_percent))
 
     return output_to_percent
 
 
-def pprintRecombinatorOutcomes(output_to_percent, valuable_inputs, compression_level = 1):
-    # print('Relevant outcomes:', len(output_to_percent))
-    
-    # For now, compress different bases into a single item
-    user_outcomes = Counter()
-    for state, percent in list(output_to_percent.items()):
-        ps_short = (len(state[1]), len(state[2]))
-        user_state = (
-            ps_short,
-            tuple(sorted([m.stringDescription() for m in state[1] if not m.stringDescription().startswith('Junk')])),
-            tuple(sorted([m.stringDescription() for m in state[2] if not m.stringDescription().startswith('Junk')])),
+def getValuablePoolIndices(mod_pool, valuable_mods):
+    return compileValuableMods(valuable_mods).getValuableIndices(mod_pool)
+
+
+def getValuableRepresentatives(mod_pool, valuable_pool_indices):
+    # {pool index: PoEMod it shows up as in the states} for the valuable mods of a pool
+    # Mods are grouped by identity (mod group, or description, see mod_identity) like monte_carlo.getDistinctPool,
+    #   so eg the two copies of a doubled mod are one mod in the states, and every engine dedupes states the same way
+    representatives = {}
+    return {i: representatives.setdefault(getModIdentity(mod_pool[i]), mod_pool[i]) for i in valuable_pool_indices}
+
+
+def getStateSortKey(mod):
+    # Pools in compressed states are sorted by description, identity breaks ties between different mods with the same
+    #   text (eg two mod groups sharing a description) so every engine builds the same tuple
+    if isJunkMod(mod):
+        return (mod.stringDescription(), -1)
+    return (mod.stringDescription(), getModIdentity(mod))
+
+
+def getPoolOutcomeVectors(pool_size, valuable_pool_indices, pool_freq):
+    # Every combination of a pool compresses down to "which valuable mods survived", so instead of listing
+    #   combinations, enumerate subsets of the valuable indices and count how many junk fills can go with each
+    # Returns output sizes, subset masks over valuable_pool_indices, and the probability of each row
+    k = len(valuable_pool_indices)
+    junk_count = pool_size - k
+    masks = ((np.arange(2**k)[:, None] >> np.arange(k)) & 1).astype(bool)
+    subset_sizes = masks.sum(axis=1)
+    junk_ways = np.array([math.comb(junk_count, j) for j in range(junk_count + 1)], dtype=float)
+
+    output_sizes = []
+    output_masks = []
+    output_probs = []
+    for N, pc in pool_freq.items():
+        junk_needed = N - subset_sizes
+        possible = (junk_needed >= 0) & (junk_needed <= junk_count)
+        output_sizes.append(np.full(possible.sum(), N))
+        output_masks.append(masks[possible])
+        output_probs.append(pc * junk_ways[junk_needed[possible]] / math.comb(pool_size, N))
+
+    return np.concatenate(output_sizes), np.concatenate(output_masks), np.concatenate(output_probs)
+
+
+def recombineItemsVectorized(item1, item2, valuable_mods):
+    # Same output as recombineItems, but works on valuable index masks and probability vectors
+    #   so the number of Python objects built scales with compressed states instead of combinations
+    valuable_mods = compileValuableMods(valuable_mods)
+    input_pools = {
+        'Prefix': item1.getPrefixes() + item2.getPrefixes(),
+        'Suffix': item1.getSuffixes() + item2.getSuffixes(),
+    }
+    junk_dicts = {
+        'Prefix': junk_prefix_dict,
+        'Suffix': junk_suffix_dict,
+    }
+
+    pool_states = {}
+    pool_probs = {}
+    for pool_type, mod_pool in input_pools.items():
+        valuable_pool_indices = getValuablePoolIndices(mod_pool, valuable_mods)
+        representatives = getValuableRepresentatives(mod_pool, valuable_pool_indices)
+        output_sizes, masks, probs = getPoolOutcomeVectors(
+            len(mod_pool),
+            valuable_pool_indices,
+            getBaFreq()[len(mod_pool)],
         )
 
-        if compression_level == 0:
-            print(f'{round(percent*100, 2)}% {ps_short}')
+        states = []
+        for N, mask in zip(output_sizes, masks):
+            kept_mods = [representatives[valuable_pool_indices[i]] for i in np.flatnonzero(mask)]
+            junk_mods = [PoEMod(**junk_dicts[pool_type]) for _ in range(N - len(kept_mods))]
+            states.append(tuple(sorted(kept_mods + junk_mods, key=getStateSortKey)))
+        pool_states[pool_type] = states
+        pool_probs[pool_type] = probs
+
+    # Each base is equally likely, so halve the joint prefix/suffix probabilities
+    joint_probs = np.outer(pool_probs['Prefix'], pool_probs['Suffix']) / 2
+
+    output_to_percent = Counter()
+    for pidx, sidx in zip(*np.nonzero(joint_probs)):
+        prob = float(joint_probs[pidx, sidx])
+        for item_base_index in range(0, 2):
+            compressed_state = (
+                item_base_index,
+                pool_states['Prefix'][pidx],
+                pool_states['Suffix'][sidx],
+            )
+            output_to_percent[compressed_state] += prob
+
+    return output_to_percent
+
+
+def checkRecombineEngines(item1, item2, valuable_mods, rel_tol=1e-9):
+    # Compare every other engine against the enumerating one (compact through expandCompactOutcomes)
+    # Returns (agrees, list of (engine, state, expected, actual))
+    expected = recombineItems(item1, item2, valuable_mods, engine='python')
+    engine_outcomes = {
+        'numpy': recombineItems(item1, item2, valuable_mods, engine='numpy'),
+        'cached': recombineItems(item1, item2, valuable_mods, engine='cached'),
+        'compact': expandCompactOutcomes(recombineItemsCompact(item1, item2, valuable_mods), item1, item2, valuable_mods),
+    }
+
+    mismatched = []
+    for engine, actual in engine_outcomes.items():
+        for state in set(expected) | set(actual):
+            if not math.isclose(expected.get(state, 0), actual.get(state, 0), rel_tol=rel_tol, abs_tol=1e-12):
+                mismatched.append((engine, state, expected.get(state, 0), actual.get(state, 0)))
+    return (len(mismatched) == 0, mismatched)
+
+
+@dataclass
+class RecombOutcomeCache:
+    # LRU cache of canonical recomb distributions, see recombineItemsCached
+    maxsize: int = 4096
+    entries: OrderedDict = field(default_factory=OrderedDict)
+    hits: int = 0
+    misses: int = 0
+
+    def get(self, signature):
+        canonical = self.entries.get(signature)
+        if canonical is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(signature)
+        return canonical
+
+    def put(self, signature, canonical):
+        self.entries[signature] = canonical
+        self.entries.move_to_end(signature)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+recomb_outcome_cache = RecombOutcomeCache()
+
+
+def getPoolSignature(pool_size, valuable_count):
+    # The frequency row is part of the signature so the cache stays correct if bafreq changes
+    return (pool_size, valuable_count, tuple(sorted(getBaFreq()[pool_size].items())))
+
+
+def getCanonicalPoolOutcomes(pool_signature):
+    # (surviving valuable ordinals, junk count, probability) for one pool, independent of the actual mods
+    # Ordinals index into the list of valuable mods of that pool, in pool order
+    pool_size, valuable_count, pool_freq = pool_signature
+    output_sizes, masks, probs = getPoolOutcomeVectors(pool_size, range(valuable_count), dict(pool_freq))
+    return [
+        (tuple(np.flatnonzero(mask).tolist()), int(N) - int(mask.sum()), float(prob))
+        for N, mask, prob in zip(output_sizes, masks, probs)
+    ]
+
+
+def combineCanonicalPools(prefix_outcomes, suffix_outcomes):
+    canonical = []
+    for prefix_ordinals, prefix_junk, ppc in prefix_outcomes:
+        for suffix_ordinals, suffix_junk, spc in suffix_outcomes:
+            if ppc * spc == 0:
+                continue
+            canonical.append((ppc * spc / 2, prefix_ordinals, prefix_junk, suffix_ordinals, suffix_junk))
+    return canonical
+
+
+def getCanonicalOutcomes(prefix_signature, suffix_signature):
+    # Distribution over (base, surviving valuable ordinals, junk count) per pool, independent of the actual mods
+    return combineCanonicalPools(getCanonicalPoolOutcomes(prefix_signature), getCanonicalPoolOutcomes(suffix_signature))
+
+
+def getRecombSignature(item1, item2, valuable_mods):
+    # (prefix, suffix) pool signatures recombineItemsCached and recombineItemsCompact look this pair up under
+    valuable_mods = compileValuableMods(valuable_mods)
+    return tuple(
+        getPoolSignature(len(mod_pool), len(getValuablePoolIndices(mod_pool, valuable_mods)))
+        for mod_pool in [item1.getPrefixes() + item2.getPrefixes(), item1.getSuffixes() + item2.getSuffixes()]
+    )
+
+
+def fillRecombOutcomeCache(signatures, cache=recomb_outcome_cache):
+    # Put the canonical distribution of every signature (from getRecombSignature) missing from cache, evaluating
+    #   each distinct pool signature once across all of them, returns how many pool signatures were evaluated
+    pool_outcomes = {}
+    for signature in dict.fromkeys(signatures):
+        if signature in cache.entries:
+            continue
+        for pool_signature in signature:
+            if pool_signature not in pool_outcomes:
+                pool_outcomes[pool_signature] = getCanonicalPoolOutcomes(pool_signature)
+        cache.put(signature, combineCanonicalPools(*[pool_outcomes[pool_signature] for pool_signature in signature]))
+    return len(pool_outcomes)
+
+
+def recombineItemsCached(item1, item2, valuable_mods, cache=recomb_outcome_cache):
+    # Same output as recombineItems
+    # The distribution only depends on pool sizes and how many mods are valuable per pool (and bafreq),
+    #   so it is cached under that signature and then filled in with the actual valuable mods of this pair
+    valuable_mods = compileValuableMods(valuable_mods)
+    input_pools = {
+        'Prefix': item1.getPrefixes() + item2.getPrefixes(),
+        'Suffix': item1.getSuffixes() + item2.getSuffixes(),
+    }
+    valuable_pool_mods = {
+        pool_type: list(getValuableRepresentatives(mod_pool, getValuablePoolIndices(mod_pool, valuable_mods)).values())
+        for pool_type, mod_pool in input_pools.items()
+    }
+
+    signature = (
+        getPoolSignature(len(input_pools['Prefix']), len(valuable_pool_mods['Prefix'])),
+        getPoolSignature(len(input_pools['Suffix']), len(valuable_pool_mods['Suffix'])),
+    )
+    canonical = cache.get(signature)
+    if canonical is None:
+        canonical = getCanonicalOutcomes(*signature)
+        cache.put(signature, canonical)
+
+    # Each pool state shows up in many joint states, so only build its mod tuple once per call
+    materialized = {}
+    def materializePool(pool_type, ordinals, junk_count, junk_dict):
+        key = (pool_type, ordinals, junk_count)
+        if key not in materialized:
+            kept_mods = [valuable_pool_mods[pool_type][o] for o in ordinals]
+            junk_mods = [PoEMod(**junk_dict) for _ in range(junk_count)]
+            materialized[key] = tuple(sorted(kept_mods + junk_mods, key=getStateSortKey))
+        return materialized[key]
+
+    output_to_percent = Counter()
+    for prob, prefix_ordinals, prefix_junk, suffix_ordinals, suffix_junk in canonical:
+        compressed_prefix_pool = materializePool('Prefix', prefix_ordinals, prefix_junk, junk_prefix_dict)
+        compressed_suffix_pool = materializePool('Suffix', suffix_ordinals, suffix_junk, junk_suffix_dict)
+        for item_base_index in range(0, 2):
+            output_to_percent[(item_base_index, compressed_prefix_pool, compressed_suffix_pool)] += prob
+
+    return output_to_percent
+
+
+def recombineItemsCompact(item1, item2, valuable_mods, cache=recomb_outcome_cache):
+    # Same distribution as recombineItemsCached, but states are (item_base_index, prefix ids, suffix ids)
+    #   using interned mod ids from mod_intern, so hashing and sorting only touch ints
+    # Like the representatives of the other engines, valuable mods sharing an identity collapse into one id,
+    #   use expandCompactOutcomes to get PoEMods back
+    input_pools = {
+        'Prefix': compactMods(item1.getPrefixes() + item2.getPrefixes()),
+        'Suffix': compactMods(item1.getSuffixes() + item2.getSuffixes()),
+    }
+    valuable_mods = compileValuableMods(valuable_mods)
+    descriptions = mod_intern_table.descriptions
+    valuable_pool_ids = {
+        pool_type: [cm.mod_id for cm in mod_pool if valuable_mods.isValuable(cm.mod)]
+        for pool_type, mod_pool in input_pools.items()
+    }
+
+    signature = (
+        getPoolSignature(len(input_pools['Prefix']), len(valuable_pool_ids['Prefix'])),
+        getPoolSignature(len(input_pools['Suffix']), len(valuable_pool_ids['Suffix'])),
+    )
+    canonical = cache.get(signature)
+    if canonical is None:
+        canonical = getCanonicalOutcomes(*signature)
+        cache.put(signature, canonical)
+
+    materialized = {}
+    def materializePool(pool_type, ordinals, junk_count, junk_id):
+        key = (pool_type, ordinals, junk_count)
+        if key not in materialized:
+            ids = [valuable_pool_ids[pool_type][o] for o in ordinals] + [junk_id] * junk_count
+            materialized[key] = tuple(sorted(ids, key=lambda mod_id: (descriptions[mod_id], mod_id)))
+        return materialized[key]
+
+    output_to_percent = Counter()
+    for prob, prefix_ordinals, prefix_junk, suffix_ordinals, suffix_junk in canonical:
+        compressed_prefix_pool = materializePool('Prefix', prefix_ordinals, prefix_junk, JUNK_PREFIX_ID)
+        compressed_suffix_pool = materializePool('Suffix', suffix_ordinals, suffix_junk, JUNK_SUFFIX_ID)
+        for item_base_index in range(0, 2):
+            output_to_percent[(item_base_index, compressed_prefix_pool, compressed_suffix_pool)] += prob
+
+    return output_to_percent
+
+
+def expandCompactOutcomes(compact_output_to_percent, item1, item2, valuable_mods=None):
+    # Turn recombineItemsCompact output back into the usual PoEMod states for display
+    # Given the same valuable_mods, ids expand to the same representative PoEMods as the other engines' states
+    source_mods = {
+        JUNK_PREFIX_ID: CompactMod(JUNK_PREFIX_ID, SLOT_CODES['Prefix'], -1),
+        JUNK_SUFFIX_ID: CompactMod(JUNK_SUFFIX_ID, SLOT_CODES['Suffix'], -1),
+    }
+    compact_mods = compactMods(item1.getPrefixes() + item2.getPrefixes() + item1.getSuffixes() + item2.getSuffixes())
+    if valuable_mods is not None:
+        valuable_mods = compileValuableMods(valuable_mods)
+        for cm in compact_mods:
+            if valuable_mods.isValuable(cm.mod):
+                source_mods.setdefault(cm.mod_id, cm)
+    for cm in compact_mods:
+        source_mods.setdefault(cm.mod_id, cm)
+
+    def expandPool(ids):
+        mods = [expandCompactMod(source_mods[mod_id], junk_prefix_dict, junk_suffix_dict) for mod_id in ids]
+        return tuple(sorted(mods, key=getStateSortKey))
+
+    output_to_percent = Counter()
+    for (item_base_index, prefix_ids, suffix_ids), percent in compact_output_to_percent.items():
+        output_to_percent[(item_base_index, expandPool(prefix_ids), expandPool(suffix_ids))] += percent
+    return output_to_percent
+
+
+def isJunkMod(m):
+    # Works for both PoEMods and interned ids from recombineItemsCompact
+    if isinstance(m, int):
+        return m == JUNK_PREFIX_ID or m == JUNK_SUFFIX_ID
+    return m.stringDescription().startswith('Junk')
+
+
+def getModDescription(m):
+    # Works for both PoEMods and interned ids from recombineItemsCompact
+    if isinstance(m, int):
+        return mod_intern_table.getDescription(m)
+    return m.stringDescription()
+
+
+def getOutcomeGoodness(valuables, max_valuable_input):
+    # 'green' (gain mods), 'yellow' (stay max mods) or 'red' (lose mods), relative to the best input
+    valuable_score = valuables - max_valuable_input # Number of mods lost relative to parent inputs
+    if valuable_score < 0 or valuables == 0:
+        goodness = 'red'
+    if valuable_score == 0:
+        goodness = 'yellow'
+    if valuable_score > 0:
+        goodness = 'green'
+    return goodness
+
+
+def getLevel3Outcomes(output_to_percent, valuable_inputs):
+    # Same categories as compression_level=3 of pprintRecombinatorOutcomes, without building the other levels
+    # Keys are 'green' (gain mods), 'yellow' (stay max mods), 'red' (lose mods) and 'BRICK'
+    level3_outcomes = Counter()
+    max_valuable_input = max(valuable_inputs)
+    for state, percent in output_to_percent.items():
+        valuables = sum(not isJunkMod(m) for pool in state[1:] for m in pool)
+        if valuables == 0:
+            level3_outcomes['BRICK'] += percent
+        else:
+            level3_outcomes[getOutcomeGoodness(valuables, max_valuable_input)] += percent
+
+    return level3_outcomes
+
+
+# Exact split/annul engines over the same compressed states as recombineItems, so crafting steps chain as
+#   distributions: annulOutcomes(recombineItems(...)), splitOutcomes(annulOutcomes(...)), ...
+# Per state results are memoized, states coming out of one step are mostly the same few tuples going into the next
+# Only the pool tuples are looked at, so anything hashable works as a mod (planner states use descriptions)
+annul_outcome_cache = RecombOutcomeCache()
+split_outcome_cache = RecombOutcomeCache()
+
+
+def compressItem(item, valuable_mods, item_base_index=0):
+    # An item as a compressed state, the same way recombineItems compresses its outputs
+    valuable_mods = compileValuableMods(valuable_mods)
+    pools = []
+    for mod_pool, junk_dict in [(item.getPrefixes(), junk_prefix_dict), (item.getSuffixes(), junk_suffix_dict)]:
+        representatives = getValuableRepresentatives(mod_pool, valuable_mods.getValuableIndices(mod_pool))
+        pools.append(tuple(sorted(
+            (representatives[i] if i in representatives else PoEMod(**junk_dict) for i in range(len(mod_pool))),
+            key=getStateSortKey,
+        )))
+    return (item_base_index, *pools)
+
+
+def annulState(state, cache=annul_outcome_cache):
+    # Annulment removes one explicit mod uniformly at random (implicits aren't part of the state, so never them)
+    # Returns {state: probability}, an item without explicit mods is left as is
+    outcomes = cache.get(state)
+    if outcomes is None:
+        item_base_index, prefixes, suffixes = state
+        explicit_count = len(prefixes) + len(suffixes)
+        outcomes = Counter()
+        for i in range(len(prefixes)):
+            outcomes[(item_base_index, prefixes[:i] + prefixes[i+1:], suffixes)] += 1 / explicit_count
+        for i in range(len(suffixes)):
+            outcomes[(item_base_index, prefixes, suffixes[:i] + suffixes[i+1:])] += 1 / explicit_count
+        if explicit_count == 0:
+            outcomes[state] = 1.0
+        cache.put(state, outcomes)
+    return outcomes
+
+
+def splitState(state, cache=split_outcome_cache):
+    # Same assumptions as splitItem in simulator.ipynb:
+    # 1. produces two items which are centered around (mod count)/2, eg 5 -> 2 + 3
+    # 2. does not care about prefix/suffix balancing
+    # Both halves keep the base, returns {(smaller half, bigger half): probability}
+    outcomes = cache.get(state)
+    if outcomes is None:
+        item_base_index, prefixes, suffixes = state
+        explicit_count = len(prefixes) + len(suffixes)
+        combos = list(itertools.combinations(range(explicit_count), explicit_count // 2))
+        outcomes = Counter()
+        for combo in combos:
+            in_a = [i in combo for i in range(explicit_count)]
+            # Subsequences of sorted pools stay sorted, so the halves are compressed states as they are
+            a_state = (
+                item_base_index,
+                tuple(m for m, a in zip(prefixes, in_a) if a),
+                tuple(m for m, a in zip(suffixes, in_a[len(prefixes):]) if a),
+            )
+            b_state = (
+                item_base_index,
+                tuple(m for m, a in zip(prefixes, in_a) if not a),
+                tuple(m for m, a in zip(suffixes, in_a[len(prefixes):]) if not a),
+            )
+            outcomes[(a_state, b_state)] += 1 / len(combos)
+        cache.put(state, outcomes)
+    return outcomes
+
+
+def keepMoreValuableHalf(a_state, b_state):
+    # Default split choice: the half with more valuable mods, then the one with less junk, then the bigger one
+    def rank(state):
+        mods = state[1] + state[2]
+        valuables = sum(not isJunkMod(m) for m in mods)
+        return (valuables, -(len(mods) - valuables))
+    return b_state if rank(b_state) >= rank(a_state) else a_state
+
+
+def annulOutcomes(output_to_percent):
+    # Annul every state of a distribution, eg annulOutcomes(recombineItems(...))
+    annulled = Counter()
+    for state, percent in output_to_percent.items():
+        for annulled_state, p in annulState(state).items():
+            annulled[annulled_state] += percent * p
+    return annulled
+
+
+def splitOutcomes(output_to_percent, keep=keepMoreValuableHalf):
+    # Split every state of a distribution and keep one half, keep(a_state, b_state) picks which
+    kept = Counter()
+    for state, percent in output_to_percent.items():
+        for (a_state, b_state), p in splitState(state).items():
+            kept[keep(a_state, b_state)] += percent * p
+    return kept
+
+
+@dataclass
+class RecombOutcomeSummary:
+    # Every compression level of pprintRecombinatorOutcomes, unsorted, see summarizeRecombOutcomes
+    valuable_inputs: tuple
+    states: Counter # Level 0, output_to_percent as given
+    user_outcomes: Counter # Level 1, bases merged: ((prefix count, suffix count), prefix descriptions, suffix descriptions)
+    level2_outcomes: Counter # Level 2, pool sizes merged: (goodness, prefix descriptions, suffix descriptions)
+    level3_outcomes: Counter # Level 3: 'green', 'yellow', 'red', 'BRICK'
+    level3_prefix_suffix: dict # goodness -> Counter of (prefix count, suffix count), bricks count as 'red' here
+
+    @property
+    def p_gain(self):
+        return self.level3_outcomes['green']
+
+    @property
+    def p_stay(self):
+        return self.level3_outcomes['yellow']
+
+    @property
+    def p_lose(self):
+        return self.level3_outcomes['red']
+
+    @property
+    def p_brick(self):
+        return self.level3_outcomes['BRICK']
+
+
+def summarizeRecombOutcomes(output_to_percent, valuable_inputs):
+    # Aggregate every compression level in one pass over output_to_percent (the higher levels are folded from the much
+    #   smaller level 1 counter), with no sorting by percent and no printing
+    # Accepts states from any recombine engine, including interned ids from recombineItemsCompact
+    max_valuable_input = max(valuable_inputs)
+    summary = RecombOutcomeSummary(
+        tuple(valuable_inputs),
+        output_to_percent,
+        Counter(),
+        Counter(),
+        Counter(),
+        defaultdict(Counter),
+    )
+
+    # Interned id states (recombineItemsCompact) look descriptions up in the intern table
+    describe = PoEMod.stringDescription
+    for state in output_to_percent:
+        if state[1] or state[2]:
+            if isinstance((state[1] or state[2])[0], int):
+                describe = mod_intern_table.descriptions.__getitem__
+            break
+
+    # Engines share one pool tuple between the states it appears in (every base, every pairing with the other pool),
+    #   so the sorted valuable descriptions are worked out once per pool object
+    # Keyed by id since hashing PoEMod tuples costs more than the work saved, output_to_percent keeps the pools alive
+    valuable_descriptions = {}
+    getValuableDescriptions = valuable_descriptions.get
+    for (item_base_index, prefix_pool, suffix_pool), percent in output_to_percent.items():
+        prefixes = getValuableDescriptions(id(prefix_pool))
+        if prefixes is None:
+            prefixes = tuple(sorted([d for d in map(describe, prefix_pool) if not d.startswith('Junk')]))
+            valuable_descriptions[id(prefix_pool)] = prefixes
+        suffixes = getValuableDescriptions(id(suffix_pool))
+        if suffixes is None:
+            suffixes = tuple(sorted([d for d in map(describe, suffix_pool) if not d.startswith('Junk')]))
+            valuable_descriptions[id(suffix_pool)] = suffixes
+        summary.user_outcomes[((len(prefix_pool), len(suffix_pool)), prefixes, suffixes)] += percent
+
+    for (ps_short, prefixes, suffixes), percent in summary.user_outcomes.items():
+        valuables = len(prefixes) + len(suffixes)
+        goodness = getOutcomeGoodness(valuables, max_valuable_input)
+        summary.level2_outcomes[(goodness, prefixes, suffixes)] += percent
+        summary.level3_prefix_suffix[goodness][ps_short] += percent
+        summary.level3_outcomes['BRICK' if valuables == 0 else goodness] += percent
+
+    return summary
+
+
+def renderRecombOutcomes(summary, compression_level = 1):
+    # Print one compression level of a RecombOutcomeSummary
+    max_valuable_input = max(summary.valuable_inputs)
+    byPercent = lambda outcomes: sorted(outcomes.items(), key=lambda x: x[1], reverse=True)
+
+    if compression_level == 0:
+        for state, percent in summary.states.items():
+            print(f'{round(percent*100, 2)}% {(len(state[1]), len(state[2]))}')
             for pool_idx in range(1, 3):
                 for m in state[pool_idx]:
-                    print(m.stringDescription())
+                    print(getModDescription(m))
             print()
-        
-        user_outcomes[user_state] += percent
-
-
-    level2_outcomes = Counter()
-    level3_prefix_suffix = {}
-    for outcome, percent in sorted(user_outcomes.items(), key=lambda x: x[1], reverse=True):
-        ps_short = outcome[0]
-        
-        valuables = len(outcome[1]) + len(outcome[2])
-        valuable_score = valuables - max(valuable_inputs) # Number of mods lost relative to parent inputs
-        if valuable_score < 0 or valuables == 0:
-            goodness = 'red'
-        if valuable_score == 0:
-            goodness = 'yellow'
-        if valuable_score > 0:
-            goodness = 'green'
-
-        if goodness not in level3_prefix_suffix:
-            level3_prefix_suffix[goodness] = defaultdict(float)
-        level3_prefix_suffix[goodness][ps_short] += percent
-
-        level2_state = (
-            goodness,
-            *outcome[1:]
-        )
-        level2_outcomes[level2_state] += percent
-        
-        if compression_level == 1:
+        return
+
+    # Ties keep the order outcomes first show up in the level 1 listing, like when every level was built from it
+    # Sums are rounded for the comparison, equal chances summed in a different order can differ in the last bits
+    level1_outcomes = []
+    level1_order = {}
+    level3_ps_order = {}
+    for (ps_short, prefixes, suffixes), percent in byPercent(summary.user_outcomes):
+        goodness = getOutcomeGoodness(len(prefixes) + len(suffixes), max_valuable_input)
+        level1_outcomes.append((goodness, ps_short, prefixes, suffixes, percent))
+        level1_order.setdefault((goodness, prefixes, suffixes), len(level1_order))
+        level3_ps_order.setdefault((goodness, ps_short), len(level3_ps_order))
+
+    if compression_level == 1:
+        for goodness, ps_short, prefixes, suffixes, percent in level1_outcomes:
             cprint(f'{round(percent*100, 2)}% {ps_short}', goodness)
-            for sm in outcome[1]:
+            for sm in prefixes:
                 print(f'(Prefix) {sm}')
-            for sm in outcome[2]:
+            for sm in suffixes:
                 print(f'(Suffix) {sm}')
             print()
-    
-    level3_outcomes = Counter()
-    for outcome, percent in sorted(level2_outcomes.items(), key=lambda x: x[1], reverse=True):
-        goodness = outcome[0]
-        valuables = len(outcome[1]) + len(outcome[2])
 
-        if valuables == 0:
-            level3_outcomes['BRICK'] += percent
-        else:
-            level3_outcomes[goodness] += percent
-        
-        if compression_level == 2:
+    elif compression_level == 2:
+        level2_outcomes = sorted(summary.level2_outcomes.items(), key=lambda x: (-round(x[1], 12), level1_order[x[0]]))
+        for (goodness, prefixes, suffixes), percent in level2_outcomes:
             cprint(f'{round(percent*100, 2)}%', goodness)
-            for sm in outcome[1]:
+            for sm in prefixes:
                 print(f'(Prefix) {sm}')
-            for sm in outcome[2]:
+            for sm in suffixes:
                 print(f'(Suffix) {sm}')
-            if valuables == 0:
+            if len(prefixes) + len(suffixes) == 0:
                 cprint('BRICK', 'red', attrs=['bold'])
             print()
 
-    if compression_level == 3:
+    elif compression_level == 3:
         messages = {
             'red': 'Lose mods',
             'yellow': 'Stay max mods',
             'green': 'Gain mods',
             'BRICK': 'BRICK',
         }
-        for goodness, percent in sorted(level3_outcomes.items(), key=lambda x: x[1], reverse=True):
+        # Ties go gain, stay, lose, BRICK instead of whichever category was summed first
+        category_order = ['green', 'yellow', 'red', 'BRICK']
+        level3_outcomes = sorted(summary.level3_outcomes.items(), key=lambda x: (-round(x[1], 12), category_order.index(x[0])))
+        for goodness, percent in level3_outcomes:
             pcstr = round(percent * 100, 1)
 
             color = goodness
@@ -238,13 +816,15 @@ def pprintRecombinatorOutcomes(output_to_percent, valuable_inputs, compression_l
             cprint(f'{messages[goodness]}: {pcstr}%', color)
             
             if goodness != 'BRICK':
-                for ps_short, ps_percent in sorted(level3_prefix_suffix[goodness].items(), key=lambda x: x[1], reverse=True):
+                ps_outcomes = sorted(
+                    summary.level3_prefix_suffix[goodness].items(),
+                    key=lambda x: (-round(x[1], 12), level3_ps_order[(goodness, x[0])]),
+                )
+                for ps_short, ps_percent in ps_outcomes:
                     print('   ', ps_short, f'{str(round(ps_percent * 100, 1)).rjust(5)}%')
 
-        # display(level3_prefix_suffix)
 
-
-@dataclass
-class ValuableMod:
-    description: str
-    min_tier: int
+def pprintRecombinatorOutcomes(output_to_percent, valuable_inputs, compression_level = 1):
+    summary = summarizeRecombOutcomes(output_to_percent, valuable_inputs)
+    renderRecombOutcomes(summary, compression_level)
+    return summary
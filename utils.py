@@ -1,9 +1,16 @@
+import contextlib
+import io
 import json
 import re
+import time
 import traceback
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from termcolor import colored, cprint
 
+from instrumentation import instrumentation
+from mod_identity import getModIdentity
 from poe_types import *
 
 
@@ -43,7 +50,43 @@ def grabLinesUntilSeparator(lines, index_start, separator):
     return captured, i
 
 
-def parseItem(lines, file_from):
+def convertModTextToGeneric(mod_text):
+    # Replace every number/range in a mod text with X, same form as PoEEffect.description
+    # Mods from RePoE don't have int before (), but mods from in game do, so handle both:
+    #   '(55-64)% increased Physical Damage' and 'Adds 11(11-14) to 25(21-25) Physical Damage'
+    lines = mod_text.split('\n')
+    generic_lines = []
+    for l in lines:
+        # https://regex101.com/r/AjXLZe/1
+        quantity_matches = validateAndReturn(l, r'([\d\.]+)?(\([\d\-\.].*?\))?')
+        quantity_matches = [q for q in quantity_matches if q != ('', '')]
+        if len(quantity_matches) == 0:
+            # Non number modification like "Hits have Culling Strike"
+            generic_lines.append(l)
+        else:
+            # Some number modification like "Adds 20(20-26) to 47(40-47) Physical Damage"
+            # For description, replace number data with X, so output is "Adds X to X Physical Damage"
+            # https://regex101.com/r/05b4zw/1
+            output_description = []
+            last_idx = 0
+            for match in quantity_matches:
+                full_match = ''.join(match)
+                start_index = l.index(full_match, last_idx)
+                end_index = start_index + len(full_match)
+                if start_index > last_idx:
+                    output_description.append(l[last_idx:start_index])
+                output_description.append('X')
+                last_idx = end_index
+            if last_idx < len(l):
+                output_description.append(l[last_idx:])
+            output_description = ''.join(output_description)
+    
+            generic_lines.append(output_description)
+    
+    return '\n'.join(generic_lines)
+
+
+def parseItemLegacy(lines, file_from):
     separator = '--------'
     separator_indices = [i for i, x in enumerate(lines) if x == separator]
     name = ''
@@ -279,7 +322,256 @@ def parseItem(lines, file_from):
         return None
         
 
-def getMatchingModIndices(modlist_1, modlist_2):
+SEPARATOR = '--------'
+ITEM_CLASS_RE = re.compile(r'Item Class: (.*)')
+RARITY_RE = re.compile(r'Rarity: (.*)')
+TRAIT_VALUE_RE = re.compile(r'[\d\.\-]+%?')
+SOCKETS_RE = re.compile(r'Sockets: (.*)')
+ITEM_LEVEL_RE = re.compile(r'Item Level: (.*)')
+MOD_TITLE_RE = re.compile(r'\"(.*)\"')
+MOD_TIER_RE = re.compile(r'\(Tier: (.*)\)')
+MOD_TAGS_RE = re.compile(r'— (.*) }')
+MOD_CATEGORY_RE = re.compile(r'{ (.*?) [\"\(—\}]')
+QUANTITY_RE = re.compile(r'([\d\.]+)(\([\d\-\.].*?\))?')
+
+
+def iterSeparatedGroups(lines, index_start):
+    # Yields (group lines, is_final) for every separator delimited group, reading lines exactly once
+    # is_final marks the group that runs into the end of lines (there is no separator after it)
+    group = []
+    for i in range(index_start, len(lines)):
+        line = lines[i]
+        if line == SEPARATOR:
+            yield group, False
+            group = []
+        else:
+            group.append(line)
+    yield group, True
+
+
+def parseTraits(trait_lines):
+    # Critical Strike Chance: 5.00%
+    # Attacks per Second: 1.20
+    # Weapon Range: 1.1 metres
+    # Elemental Damage: 30-50 (augmented)
+    trait_dict = {}
+    for raw_trait in trait_lines:
+        parts = raw_trait.split(':')
+        if len(parts) == 1:
+            # Sometimes the Item Class is here again for some reason.
+            #   In this case it is still traits, but the first line should be ignored
+            continue
+
+        trait = parts[0]
+        value = TRAIT_VALUE_RE.search(':'.join(parts[1:])).group(0)
+
+        if '-' in value and value[0] != '-':
+            # Value is a range, eg. "Elemental Damage: 30-50 (augmented)"
+            # For now just average two values
+            lrparts = value.split('-')
+            if len(lrparts) != 2:
+                raise NotImplementedError(f'Unable to parse {raw_trait}')
+            else:
+                left, right = lrparts
+                value = str((float(right) + float(left))/2)
+
+        if value.endswith('%'):
+            value = float(value[:-1]) / 100
+        else:
+            value = float(value)
+        trait_dict[trait] = value
+
+    return trait_dict
+
+
+def parseEffect(effect_raw_line):
+    quantity_matches = QUANTITY_RE.findall(effect_raw_line)
+    if len(quantity_matches) == 0:
+        # Some non number modification like "Hits have Culling Strike"
+        return PoEEffect([], [], effect_raw_line, [])
+
+    # Some number modification like "Adds 20(20-26) to 47(40-47) Physical Damage"
+    # For description, replace number data with X, so output is "Adds X to X Physical Damage"
+    output_description = []
+    actual_stats = []
+    ranges = []
+    last_idx = 0
+    for stat, range_raw in quantity_matches:
+        full_match = stat + range_raw
+        # First occurrence lookup (not the match position) on purpose, this keeps descriptions identical to parseItemLegacy
+        start_index = effect_raw_line.find(full_match)
+        if start_index > last_idx:
+            output_description.append(effect_raw_line[last_idx:start_index])
+        output_description.append('X')
+        last_idx = start_index + len(full_match)
+
+        st = float(stat)
+        actual_stats.append(st)
+        if range_raw == '':
+            # eg "32% reduced Attribute Requirements" so no second match
+            ranges.append([st, st])
+        else:
+            # something like (20-26)
+            ranges.append([float(x) for x in range_raw.strip('()').split('-')])
+    if last_idx < len(effect_raw_line):
+        output_description.append(effect_raw_line[last_idx:])
+
+    return PoEEffect(
+        actual_stats = actual_stats,
+        ranges = ranges,
+        description = ''.join(output_description),
+        comment_lines = [],
+    )
+
+
+def parseModifierGroup(modifier_lines, final_mods):
+    # Every line that starts with "{" is a modifier start, everything until the next one belongs to it
+    mod = None
+    for ml in modifier_lines:
+        if ml.startswith('{'):
+            title = MOD_TITLE_RE.search(ml) # eg "of the Apt"
+            tier = MOD_TIER_RE.search(ml) # eg (Tier: 1)
+            tags = MOD_TAGS_RE.search(ml) # eg Elemental, Cold, Ailment
+            mod = PoEMod(
+                category = MOD_CATEGORY_RE.search(ml).group(1), # eg Eater of Worlds Implicit Modifier, Master Crafted Suffix Modifier
+                title = title.group(1) if title else '',
+                tier = int(tier.group(1)) if tier else 0,
+                tags = tags.group(1).split(', ') if tags else [],
+                effects = [],
+            )
+            final_mods.append(mod)
+        elif ml.startswith('('):
+            mod.effects[-1].comment_lines.append(ml)
+        else:
+            mod.effects.append(parseEffect(ml))
+
+
+def parseItem(lines, file_from, raise_errors=False):
+    # Single pass replacement for parseItemLegacy, produces identical PoEItems (see checkParseItemEquivalence)
+    # Prints the error and returns None for items that fail to parse, unless raise_errors (see item_stream)
+    name = ''
+
+    try:
+        iclass = ITEM_CLASS_RE.search(lines[0]).group(1)
+        rarity = RARITY_RE.search(lines[1]).group(1)
+
+        if lines[3] == SEPARATOR:
+            # Sometimes there are items with no name, only base plus modifier title
+            # eg. "Padded Vest of the Lynx" or "Healthy Copper Plate of the Cloud"
+            name = ''
+            base = lines[2]
+            separator_index = 3
+        else:
+            name = lines[2]
+            base = lines[3]
+            separator_index = 4
+
+        assert lines[separator_index] == SEPARATOR
+        groups = iterSeparatedGroups(lines, separator_index + 1)
+
+        # Can either be traits or requirements first, have to check
+        group, is_final = next(groups)
+        trait_dict = {}
+        if not group or group[0] != 'Requirements:':
+            assert not is_final, 'Item ends before requirements'
+            trait_dict = parseTraits(group)
+            group, is_final = next(groups)
+
+        # Requirements
+        assert group and group[0] == 'Requirements:'
+        assert not is_final, 'Item ends after requirements'
+        req_obj = PoEReq(0, 0, 0, 0)
+        for raw_req in group[1:]:
+            req, value = raw_req.split(':')
+            value = value.split('(')[0]
+            setattr(req_obj, req.lower(), int(value))
+
+        # Everything else that's not a modifier, the final group is always left for the modifier section
+        socket_obj = PoESocket('')
+        ilvl = 0
+        while True:
+            group, is_final = next(groups)
+            if is_final:
+                break
+            elif group[0].startswith('Sockets'):
+                socket_obj = PoESocket(SOCKETS_RE.search(group[0]).group(1).strip(' '))
+            elif group[0].startswith('Item Level'):
+                ilvl = int(ITEM_LEVEL_RE.search(group[0]).group(1))
+            elif group[0].startswith('{'):
+                # We are on modifiers already
+                break
+
+        # Modifiers
+        leftover = False
+        final_mods = []
+        while True:
+            modifier_lines = group
+            if not modifier_lines[0].startswith('{'):
+                # Some items have final stuff tacked on like "Synthesized Item"
+                leftover = True
+                break
+            parseModifierGroup(modifier_lines, final_mods)
+
+            if is_final:
+                break
+            group, is_final = next(groups)
+
+        special_types = []
+        if leftover:
+            # This is probably something like:
+            # Synthesised Item
+            # Elder Item
+            # Fractured Item
+
+            # Check if normal item; if so, edit
+            item_lvl_match = ITEM_LEVEL_RE.search(modifier_lines[0])
+            if item_lvl_match:
+                ilvl = int(item_lvl_match.group(1))
+            else:
+                special_types = modifier_lines
+
+        return PoEItem(
+            iclass = iclass,
+            rarity = rarity,
+            name = name,
+            base = base,
+            traits = trait_dict,
+            req = req_obj,
+            sockets = socket_obj,
+            ilvl = ilvl,
+            mods = final_mods,
+            special_types = special_types,
+        )
+
+    except Exception as e:
+        if raise_errors:
+            raise
+        cprint(f'Error in item "{name}" from "{file_from}"', 'red')
+        for line in traceback.format_exception(e):
+            cprint(line, 'red')
+
+        return None
+
+
+def checkParseItemEquivalence(recombination_files_full):
+    # Run parseItem and parseItemLegacy over every item in the corpus, returns [(file name, item type)] that differ
+    mismatched = []
+    for full_fpath in recombination_files_full:
+        with open(full_fpath, 'r') as f:
+            raw_json = json.load(f)
+
+        for item_type in ['input1', 'input2', 'output']:
+            raw_item_lines = raw_json[item_type]
+            with contextlib.redirect_stdout(io.StringIO()):
+                expected = parseItemLegacy(raw_item_lines, full_fpath.name)
+                actual = parseItem(raw_item_lines, full_fpath.name)
+            if expected != actual:
+                mismatched.append((full_fpath.name, item_type))
+
+    return mismatched
+
+
+def getMatchingModIndicesLegacy(modlist_1, modlist_2):
     matching = []
     for lidx, lm in enumerate(modlist_1):
         for ridx, rm in enumerate(modlist_2):
@@ -298,45 +590,171 @@ def getMatchingModIndices(modlist_1, modlist_2):
     return matching
 
 
+def getMatchingModIndices(modlist_1, modlist_2):
+    # Pairs of [idx in modlist_1, idx in modlist_2] that are the same mod: same RePoE mod group when both resolve
+    #   (see mod_identity), otherwise equal full descriptions (all effects, in order)
+    # Indexes modlist_2 by identity, so this is linear instead of all mod pairs x all effect pairs
+    # Differences from getMatchingModIndicesLegacy, which requires every effect of one mod to equal every effect of the other:
+    #   - Hybrid mods (effects with different descriptions) now match an identical hybrid, legacy never matched them at all
+    #   - Mods that repeat one effect description ([A, A] vs [A]) no longer match
+    #   - Mods without effects only match other mods without effects, legacy matched them against everything
+    index = defaultdict(list)
+    for ridx, rm in enumerate(modlist_2):
+        index[getModIdentity(rm)].append(ridx)
+
+    matching = []
+    for lidx, lm in enumerate(modlist_1):
+        for ridx in index.get(getModIdentity(lm), []):
+            matching.append([lidx, ridx])
+
+    return matching
+
+
+def compareMatchingModIndices(recombs, repeat=5):
+    # Benchmark getMatchingModIndices against getMatchingModIndicesLegacy on the three comparisons annotateRecomb makes
+    # Returns timings per function (seconds for all records, best of repeat) and the (file name, comparison) pairs that differ
+    comparisons = [('input1', 'input2'), ('input1', 'output'), ('input2', 'output')]
+    timings = {}
+    for fxn in [getMatchingModIndicesLegacy, getMatchingModIndices]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for data in recombs.values():
+                for left, right in comparisons:
+                    fxn(data[left].mods, data[right].mods)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[fxn.__name__] = best
+
+    differences = []
+    for fpath, data in recombs.items():
+        for left, right in comparisons:
+            legacy = getMatchingModIndicesLegacy(data[left].mods, data[right].mods)
+            indexed = getMatchingModIndices(data[left].mods, data[right].mods)
+            if legacy != indexed:
+                differences.append((fpath, (left, right)))
+
+    return timings, differences
+
+
+def parseRecombFile(full_fpath):
+    fpath = full_fpath.name
+    record = {}
+
+    with open(full_fpath, 'r') as f:
+        raw_json = json.load(f)
+
+    for item_type in ['input1', 'input2', 'output']:
+        raw_item_lines = raw_json[item_type]
+        item = parseItem(raw_item_lines, fpath)
+        if item is not None:
+            record[item_type] = item
+
+    return record
+
+
+def annotateRecomb(data):
+    # Add "doubled" and "kept" marker to PoEMods
+    # Mods are compared by RePoE mod group when data/repoe_index.sqlite is available, by description otherwise
+    left_mods = data['input1'].mods
+    right_mods = data['input2'].mods
+    output_mods = data['output'].mods
+
+    # Groups (or descriptions) must match for the PoEMod to be the same
+    # NOTE that this marks implicits as doubled, although "doubled" is not meaningful for implicits (since implicits don't mix - they come from the base)
+    lr_matching = getMatchingModIndices(left_mods, right_mods)
+    for lidx, ridx in lr_matching:
+        data['input1'].mods[lidx].doubled.append([lidx, ridx])
+        data['input2'].mods[ridx].doubled.append([lidx, ridx])
+
+    lo_matching = getMatchingModIndices(left_mods, output_mods)
+    for lidx, oidx in lo_matching:
+        data['input1'].mods[lidx].kept.append([lidx, oidx])
+
+    ro_matching = getMatchingModIndices(right_mods, output_mods)
+    for ridx, oidx in ro_matching:
+        data['input2'].mods[ridx].kept.append([ridx, oidx])
+
+
+def countParseFailures(record):
+    # Instrumentation counters for one parsed record, a failure is any of the three items not parsing
+    instrumentation.count('files_parsed')
+    if len(record) < 3:
+        instrumentation.count('parse_failures')
+
+
 def loadRecombsFromFileList(recombination_files_full):
-    recombination_files = [p.name for p in recombination_files_full]
-    
     recombs = {}
-    for full_fpath in recombination_files_full:
-        fpath = full_fpath.name
-        recombs[fpath] = {}
-        
-        with open(full_fpath, 'r') as f:
-            raw_json = json.load(f)
-    
-        for item_type in ['input1', 'input2', 'output']:
-            raw_item_lines = raw_json[item_type]
-            item = parseItem(raw_item_lines, fpath)
-            if item is not None:
-                recombs[fpath][item_type] = item
-    
-    # Add "doubled" and "kept" marker to PoEMods
-    # This is imperfect as this is a description comparison, not a modgroup comparison ... need to look at poedb later
+    with instrumentation.timer('load.parse'):
+        for full_fpath in recombination_files_full:
+            recombs[full_fpath.name] = parseRecombFile(full_fpath)
+            countParseFailures(recombs[full_fpath.name])
+
+    with instrumentation.timer('load.annotate'):
+        for fpath in recombs:
+            annotateRecomb(recombs[fpath])
+
+    return recombs
+
+
+def loadRecombFile(full_fpath):
+    # Parse and annotate a single record, this is the unit of work for loadRecombsFromFileListParallel
+    # Returns (file name, record or None, error message or None) so failures stay attached to their record
+    fpath = full_fpath.name
+    try:
+        record = parseRecombFile(full_fpath)
+        missing = [item_type for item_type in ['input1', 'input2', 'output'] if item_type not in record]
+        if missing:
+            return (fpath, None, f'Unable to parse {", ".join(missing)}')
+        annotateRecomb(record)
+        return (fpath, record, None)
+    except Exception as e:
+        return (fpath, None, ''.join(traceback.format_exception(e)))
+
+
+def loadRecombsFromFileListParallel(recombination_files_full, max_workers=None, chunksize=16):
+    # Same records as loadRecombsFromFileList, but parsed and annotated across a process pool
+    # executor.map keeps input order, so the output dict order matches the file list regardless of worker timing
+    # Returns (recombs, errors) where errors maps file name -> message for every record that failed
+    recombs = {}
+    errors = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for fpath, record, error in executor.map(loadRecombFile, recombination_files_full, chunksize=chunksize):
+            if error is None:
+                recombs[fpath] = record
+            else:
+                errors[fpath] = error
+
+    return recombs, errors
+
+
+def getRecordPoolSizes(data):
+    # [(input prefix count, output prefix count), (input suffix count, output suffix count)] for one record
+    countSlots = lambda item, slot: sum([m.getSlot() == slot for m in item.mods])
+    pool_sizes = []
+    for slot in ['Prefix', 'Suffix']:
+        input_count = countSlots(data['input1'], slot) + countSlots(data['input2'], slot)
+        output_count = countSlots(data['output'], slot)
+        pool_sizes.append((input_count, output_count))
+    return pool_sizes
+
+
+def calculateBeforeAfter(recombs):
+    # Calculate pool size before_after
+    before_after = defaultdict(list)
     for fpath in recombs:
-        data = recombs[fpath]
-    
-        left_mods = data['input1'].mods
-        right_mods = data['input2'].mods
-        output_mods = data['output'].mods
-    
-        # Descriptions must match between PoEEffects for the PoEMod to be the same
-        # NOTE that this marks implicits as doubled, although "doubled" is not meaningful for implicits (since implicits don't mix - they come from the base)
-        lr_matching = getMatchingModIndices(left_mods, right_mods)
-        for lidx, ridx in lr_matching:
-            data['input1'].mods[lidx].doubled.append([lidx, ridx])
-            data['input2'].mods[ridx].doubled.append([lidx, ridx])
-    
-        lo_matching = getMatchingModIndices(left_mods, output_mods)
-        for lidx, oidx in lo_matching:
-            data['input1'].mods[lidx].kept.append([lidx, oidx])
-    
-        ro_matching = getMatchingModIndices(right_mods, output_mods)
-        for ridx, oidx in ro_matching:
-            data['input2'].mods[ridx].kept.append([ridx, oidx])
+        for input_count, output_count in getRecordPoolSizes(recombs[fpath]):
+            before_after[input_count].append(output_count)
+
+    return before_after
+
+
+def calculateBaFreq(before_after):
+    # Put it in a frequency version to make it simpler
+    bafreq = {}
+    for in_pool in sorted(list(before_after.keys())):
+        freq = Counter(before_after[in_pool])
+        total = freq.total()
+        bafreq[in_pool] = {outcome: round(num/total,  3) for outcome, num in freq.items()}
 
-    return recombs
\ No newline at end of file
+    return bafreq
@@ -0,0 +1,80 @@
+import re
+from dataclasses import dataclass
+
+
+@dataclass
+class ValuableMod:
+    description: str
+    min_tier: int
+
+
+@dataclass
+class ValuablePattern:
+    # Regex rule over mod descriptions, re.search'ed against PoEMod.stringDescription(), where the lines of a hybrid
+    #   mod are joined with '\n'. e.g. ValuablePattern(r'X% increased Physical Damage\n', 2) for any hybrid whose first
+    #   line is physical damage. min_tier works like ValuableMod.min_tier
+    pattern: str
+    min_tier: int
+
+
+class ValuableModSet:
+    # Compiled valuable mod rules, classifies a mod with one dict lookup instead of scanning every rule
+    # A mod is valuable if any rule matches its description and its tier is <= that rule's min_tier,
+    #   so per description only the highest allowed tier is kept
+    # Pattern results are cached per description, so each distinct description is only searched once
+    def __init__(self, valuable_mods=()):
+        self.rules = list(valuable_mods)
+        self.max_tiers = {} # description -> highest allowed tier
+        self.patterns = [] # (compiled regex, min_tier)
+        self.pattern_max_tiers = {} # description -> highest allowed tier from patterns, or None
+
+        for vm in self.rules:
+            if isinstance(vm, ValuablePattern):
+                self.patterns.append((re.compile(vm.pattern), vm.min_tier))
+            else:
+                self.max_tiers[vm.description] = max(self.max_tiers.get(vm.description, vm.min_tier), vm.min_tier)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def getMaxTier(self, description):
+        # Highest tier still counted as valuable for this description, None if no rule matches
+        max_tier = self.max_tiers.get(description)
+        if not self.patterns:
+            return max_tier
+
+        if description not in self.pattern_max_tiers:
+            matching = [min_tier for regex, min_tier in self.patterns if regex.search(description)]
+            self.pattern_max_tiers[description] = max(matching, default=None)
+        pattern_max_tier = self.pattern_max_tiers[description]
+        if pattern_max_tier is None:
+            return max_tier
+        return pattern_max_tier if max_tier is None else max(max_tier, pattern_max_tier)
+
+    def isValuableDescription(self, description, tier):
+        max_tier = self.getMaxTier(description)
+        return max_tier is not None and tier <= max_tier
+
+    def isValuable(self, mod):
+        return self.isValuableDescription(mod.stringDescription(), mod.tier)
+
+    def classifyMods(self, mods):
+        # One bool per mod, for a whole item (item.mods) or pool
+        return [self.isValuable(m) for m in mods]
+
+    def getValuableIndices(self, mods):
+        return [i for i, m in enumerate(mods) if self.isValuable(m)]
+
+    def getValuableCount(self, mods):
+        return sum(self.classifyMods(mods))
+
+
+def compileValuableMods(valuable_mods):
+    # Accepts a plain list of ValuableMod/ValuablePattern or an already compiled set
+    # Compile once up front in hot loops, everything taking valuable_mods passes a ValuableModSet straight through
+    if isinstance(valuable_mods, ValuableModSet):
+        return valuable_mods
+    return ValuableModSet(valuable_mods)